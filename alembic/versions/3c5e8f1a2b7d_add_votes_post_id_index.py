@@ -0,0 +1,26 @@
+"""add votes post_id index
+
+Revision ID: 3c5e8f1a2b7d
+Revises: 0f1226d411e5
+Create Date: 2026-10-18 10:12:41.203114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e8f1a2b7d'
+down_revision = '0f1226d411e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_votes_post_id_user_id', 'votes', ['post_id', 'user_id'])
+
+
+def downgrade() -> None:
+    # MySQL may have folded the foreign key's own index into this one, put it back first
+    op.create_index('post_id', 'votes', ['post_id'])
+    op.drop_index('ix_votes_post_id_user_id', table_name='votes')
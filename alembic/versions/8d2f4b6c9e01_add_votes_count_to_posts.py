@@ -0,0 +1,27 @@
+"""add votes_count to posts
+
+Revision ID: 8d2f4b6c9e01
+Revises: 3c5e8f1a2b7d
+Create Date: 2026-10-18 11:03:27.518842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4b6c9e01'
+down_revision = '3c5e8f1a2b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts',
+                  sa.Column('votes_count', sa.Integer(), nullable=False, server_default='0'))
+    # backfill from the votes table, later drift can be fixed with `python -m app.maintenance repair-vote-counts`
+    op.execute("UPDATE posts SET votes_count = (SELECT COUNT(*) FROM votes WHERE votes.post_id = posts.id)")
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'votes_count')
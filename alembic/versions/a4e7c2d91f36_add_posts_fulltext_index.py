@@ -0,0 +1,27 @@
+"""add posts fulltext index
+
+Revision ID: a4e7c2d91f36
+Revises: 8d2f4b6c9e01
+Create Date: 2026-10-18 12:21:09.734410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e7c2d91f36'
+down_revision = '8d2f4b6c9e01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # FULLTEXT is MySQL only, other databases use the in-process index (SEARCH_BACKEND=memory)
+    if op.get_bind().dialect.name == 'mysql':
+        op.create_index('ix_posts_title_content_fulltext', 'posts', ['title', 'content'], mysql_prefix='FULLTEXT')
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        op.drop_index('ix_posts_title_content_fulltext', table_name='posts')
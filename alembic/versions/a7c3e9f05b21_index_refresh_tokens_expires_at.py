@@ -0,0 +1,24 @@
+"""index refresh_tokens.expires_at
+
+Revision ID: a7c3e9f05b21
+Revises: f2b6d8a41c93
+Create Date: 2026-10-19 14:03:51.208317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f05b21'
+down_revision = 'f2b6d8a41c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_refresh_tokens_expires_at', 'refresh_tokens', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_refresh_tokens_expires_at', table_name='refresh_tokens')
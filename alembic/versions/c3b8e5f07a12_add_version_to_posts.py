@@ -0,0 +1,25 @@
+"""add version to posts
+
+Revision ID: c3b8e5f07a12
+Revises: a4e7c2d91f36
+Create Date: 2026-10-18 15:42:51.208316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3b8e5f07a12'
+down_revision = 'a4e7c2d91f36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts',
+                  sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'version')
@@ -17,14 +17,16 @@ depends_on = None
 
 
 def upgrade() -> None:
-    op.add_column('posts',
-                  sa.Column('owner_id', sa.Integer(), nullable=False))
-    op.create_foreign_key('post_users_fk', source_table="posts", referent_table="users", 
-                          local_cols=['owner_id'], remote_cols=['id'], ondelete="CASCADE")
+    # batch mode is plain ALTER TABLE on MySQL; SQLite can't add a constraint in place, so it copies the table
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('owner_id', sa.Integer(), nullable=False))
+        batch_op.create_foreign_key('post_users_fk', referent_table="users",
+                                    local_cols=['owner_id'], remote_cols=['id'], ondelete="CASCADE")
     pass
 
 
 def downgrade() -> None:
-    op.drop_constraint('post_users_fk', table_name="posts")
-    op.drop_column('posts', 'owner_id')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_constraint('post_users_fk', type_='foreignkey')
+        batch_op.drop_column('owner_id')
     pass
@@ -0,0 +1,38 @@
+"""add refresh tokens table
+
+Revision ID: e5a91d3c7b24
+Revises: c3b8e5f07a12
+Create Date: 2026-10-18 16:27:14.903552
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a91d3c7b24'
+down_revision = 'c3b8e5f07a12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('refresh_tokens',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('token_hash', sa.String(64), nullable=False),
+                    sa.Column('family', sa.String(32), nullable=False),
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('expires_at', sa.TIMESTAMP(timezone=True), nullable=False),
+                    sa.Column('used', sa.Boolean(), server_default='0', nullable=False),
+                    sa.Column('revoked', sa.Boolean(), server_default='0', nullable=False),
+                    sa.Column('time', sa.TIMESTAMP(timezone=True), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('token_hash')
+                    )
+    op.create_index('ix_refresh_tokens_family', 'refresh_tokens', ['family'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_refresh_tokens_family', table_name='refresh_tokens')
+    op.drop_table('refresh_tokens')
@@ -0,0 +1,25 @@
+"""add votes_seq to posts
+
+Revision ID: f2b6d8a41c93
+Revises: e5a91d3c7b24
+Create Date: 2026-10-19 10:12:37.514902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d8a41c93'
+down_revision = 'e5a91d3c7b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts',
+                  sa.Column('votes_seq', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'votes_seq')
@@ -1,15 +1,72 @@
-from pydantic import BaseSettings
+from pydantic import BaseSettings, root_validator
+from typing import List
 import os
 
 class Settings(BaseSettings):
-    database_hostname: str
-    database_port: str
-    database_password: str
-    database_name: str
-    database_username: str
+    # any SQLAlchemy URL, e.g. sqlite:///./app.db; the DATABASE_* parts below are only used without it
+    database_url: str = ""
+    database_hostname: str = ""
+    database_port: str = ""
+    database_password: str = ""
+    database_name: str = ""
+    database_username: str = ""
     secret_key: str
     algorithm: str
     access_token_expire_minutes: int
+    refresh_token_expire_days: int = 30
+    database_async: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    database_replica_urls: List[str] = []
+    replica_sticky_seconds: float = 5
+    replica_eject_seconds: float = 30
+    hash_workers: int = 0
+    hash_queue_limit: int = 64
+    principal_cache_size: int = 10000
+    principal_cache_ttl: int = 60
+    auth_claims_only: bool = False
+    token_cache_size: int = 10000
+    revocation_cache_size: int = 10000
+    revocation_cache_ttl: int = 30
+    jwt_backend: str = "jose"
+    search_backend: str = "like"
+    post_list_owner_loading: str = "selectin"
+    post_detail_owner_loading: str = "joined"
+    post_batch_max_ids: int = 100
+    post_bulk_max_items: int = 500
+    post_bulk_max_bytes: int = 2097152
+    response_cache_backend: str = "none"
+    response_cache_size: int = 1000
+    response_cache_ttl: int = 30
+    redis_url: str = "redis://localhost:6379/0"
+    slow_query_ms: float = 200
+    fast_json: bool = False
+    vote_buffer: bool = False
+    vote_buffer_max_size: int = 1000
+    vote_buffer_flush_seconds: float = 0.5
+    vote_buffer_log_path: str = ""
+    vote_buffer_fsync: bool = True
+    vote_stream_backend: str = "none"
+    vote_stream_coalesce_seconds: float = 0.25
+    vote_stream_keepalive_seconds: float = 15
+    vote_stream_max_seconds: float = 300
+    vote_stream_max_connections: int = 1000
+    db_timing_headers: bool = True
+
+    @root_validator(skip_on_failure=True)
+    def database_configured(cls, values):
+        # without DATABASE_URL every part of the MySQL URL has to be there; an empty one would only
+        # surface later as a confusing error from URL parsing
+        if values["database_url"]:
+            return values
+        parts = ("database_hostname", "database_port", "database_name", "database_username", "database_password")
+        missing = [name.upper() for name in parts if not values[name]]
+        if missing:
+            raise ValueError(f"set DATABASE_URL, or all of the DATABASE_* settings (missing: {', '.join(missing)})")
+        return values
 
     class Config:
         env_file = ".env"
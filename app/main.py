@@ -1,10 +1,14 @@
 # cd Axie-Infinity
 # source venv/bin/activate
 # pip3 install fastapi\[all\]
-from fastapi import FastAPI
-from . import models
+from contextlib import asynccontextmanager
+import time
+from fastapi import Depends, FastAPI, Request, status
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy import exc
+from . import models, oauth2, utils, search, database, vote_buffer, vote_stream
 from .database import engine
-from .routers import post, user, auth, vote
+from .routers import post, user, auth, vote, metrics
 from .config import settings
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -14,7 +18,44 @@ from fastapi.middleware.cors import CORSMiddleware
 #can leave it uncomment as well, it won't break the code
 # models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if search.enabled():
+        await search.rebuild_index()
+    if vote_buffer.buffer is not None:
+        await vote_buffer.buffer.start()
+    if vote_stream.broker is not None:
+        await vote_stream.broker.start()
+    yield
+    if vote_stream.broker is not None:
+        await vote_stream.broker.stop()
+    if vote_buffer.buffer is not None:
+        # acknowledged votes are written before the process goes
+        await vote_buffer.buffer.stop()
+    utils.shutdown_hash_executor()
+
+def route_key(request: Request):
+    # keyed by the route template so /posts/1 and /posts/2 share a histogram
+    route = request.scope.get("route")
+    return f"{request.method} {route.path if route else '<unmatched>'}"
+
+async def track_sessions(request: Request):
+    # collects the request's LazySessions; entered before and exited after every other dependency,
+    # so by the time this records them get_db and get_read_db have closed them
+    sessions = []
+    token = database.request_sessions.set(sessions)
+    try:
+        yield
+    finally:
+        database.request_sessions.reset(token)
+        finished = time.perf_counter()
+        for db in sessions:
+            if db.opened_at is not None:
+                saved = finished - db.released_holding_at if db.released_holding_at is not None else 0.0
+                metrics.route_metrics.observe_session(route_key(request), db.open_seconds, saved)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse if settings.fast_json else JSONResponse,
+              dependencies=[Depends(track_sessions)])
 
 origins = ["*"]
 
@@ -24,11 +65,48 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-DB-Queries", "Server-Timing"],
 )
+
+@app.middleware("http")
+async def read_your_writes(request: Request, call_next):
+    # a client's reads go to the primary for a while after it writes, so it sees its own write
+    writing = request.method not in database.SAFE_METHODS
+    # read by get_read_db
+    request.state.client_key = key = oauth2.client_key(request)
+    if writing:
+        database.replica_router.mark_write(key)
+    response = await call_next(request)
+    if writing:
+        database.replica_router.mark_write(key)
+    return response
+
+@app.middleware("http")
+async def query_metrics(request: Request, call_next):
+    stats = database.QueryStats(f"{request.method} {request.url.path}")
+    token = database.current_query_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        database.current_query_stats.reset(token)
+
+    metrics.route_metrics.observe(route_key(request), stats)
+    if settings.db_timing_headers:
+        response.headers["X-DB-Queries"] = str(stats.count)
+        response.headers["Server-Timing"] = f'db;dur={stats.seconds * 1000:.3f};desc="{stats.count} queries"'
+    return response
+
+@app.exception_handler(exc.TimeoutError)
+async def pool_timeout_handler(request: Request, error: exc.TimeoutError):
+    # every pooled connection stayed busy for db_pool_timeout seconds
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": "Database is busy, try again later"},
+                        headers={"Retry-After": "1"})
+
 app.include_router(post.router)
 app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(metrics.router)
 
 @app.get("/")
 async def root():
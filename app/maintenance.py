@@ -0,0 +1,78 @@
+# Maintenance commands, run against the configured database:
+#
+#   python -m app.maintenance repair-vote-counts [--batch-size 1000] [--dry-run]
+#   python -m app.maintenance prune-refresh-tokens [--batch-size 1000] [--dry-run]
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+from .config import settings
+from .database import SessionLocal
+from . import models
+
+
+def repair_vote_counts(db, batch_size: int = 1000, dry_run: bool = False):
+    # walks posts in id order so each batch is a short transaction
+    actual_votes = select(func.count(models.Vote.post_id)).where(models.Vote.post_id == models.Post.id).scalar_subquery()
+    checked = 0
+    repaired = 0
+    last_id = 0
+
+    while True:
+        ids = db.execute(select(models.Post.id).where(models.Post.id > last_id).order_by(models.Post.id).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        checked += len(ids)
+
+        drifted = db.execute(select(models.Post.id).where(models.Post.id.in_(ids), models.Post.votes_count != actual_votes)).scalars().all()
+        repaired += len(drifted)
+        if drifted and not dry_run:
+            db.execute(update(models.Post).where(models.Post.id.in_(drifted)).values(votes_count=actual_votes),
+                       execution_options={"synchronize_session": False})
+            db.commit()
+
+    return {"checked": checked, "repaired": repaired, "dry_run": dry_run}
+
+
+def prune_refresh_tokens(db, batch_size: int = 1000, dry_run: bool = False):
+    # Every refresh leaves a used row behind. Rows go once they have expired, used or not: a used
+    # token is kept until then because one coming back is how a leaked token is caught, and a
+    # revoked family is kept for another access token lifetime since it still rejects the access
+    # tokens issued with it. Deleted in batches so each is a short transaction.
+    cutoff = datetime.utcnow() - timedelta(minutes=settings.access_token_expire_minutes)
+    expired = select(models.RefreshToken.id).where(models.RefreshToken.expires_at < cutoff)
+    if dry_run:
+        return {"deleted": db.scalar(select(func.count()).select_from(expired.subquery())), "dry_run": True}
+
+    deleted = 0
+    while True:
+        ids = db.execute(expired.order_by(models.RefreshToken.expires_at).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        db.execute(delete(models.RefreshToken).where(models.RefreshToken.id.in_(ids)))
+        db.commit()
+        deleted += len(ids)
+
+    return {"deleted": deleted, "dry_run": False}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    repair = commands.add_parser("repair-vote-counts", help="recompute posts.votes_count from the votes table")
+    repair.add_argument("--batch-size", type=int, default=1000)
+    repair.add_argument("--dry-run", action="store_true", help="only report posts whose count has drifted")
+    prune = commands.add_parser("prune-refresh-tokens", help="delete expired refresh tokens, used or not")
+    prune.add_argument("--batch-size", type=int, default=1000)
+    prune.add_argument("--dry-run", action="store_true", help="only report how many would be deleted")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "repair-vote-counts":
+            print(repair_vote_counts(db, batch_size=args.batch_size, dry_run=args.dry_run))
+        elif args.command == "prune-refresh-tokens":
+            print(prune_refresh_tokens(db, batch_size=args.batch_size, dry_run=args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
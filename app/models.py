@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.expression import null
@@ -14,9 +14,15 @@ class Post(Base):
     published = Column(Boolean, default=True, server_default='1', nullable=False)
     time = Column(TIMESTAMP(timezone=True), server_default=text('CURRENT_TIMESTAMP'), nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False) # reference to table name(users)
+    votes_count = Column(Integer, default=0, server_default='0', nullable=False) # maintained by routers/vote.py
+    version = Column(Integer, default=1, server_default='1', nullable=False) # bumped by every edit, checked against If-Match
+    votes_seq = Column(Integer, default=0, server_default='0', nullable=False) # bumped with votes_count, orders the counts sent to vote streams
 
     owner = relationship("User") #reference to class name(User)
 
+    # used by SEARCH_BACKEND=fulltext, other databases search with the in-process index
+    __table_args__ = (Index("ix_posts_title_content_fulltext", "title", "content", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -30,3 +36,21 @@ class Vote(Base):
 
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
     post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+
+    # the primary key leads with user_id, so counting votes per post needs its own index
+    __table_args__ = (Index("ix_votes_post_id_user_id", "post_id", "user_id"),)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    # sha256 of the token: it is 256 random bits, so a slow hash like bcrypt would add nothing
+    token_hash = Column(String(64), nullable=False, unique=True)
+    # every token rotated out of the same login shares its family, which access tokens carry as "sid"
+    family = Column(String(32), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # indexed for app.maintenance prune-refresh-tokens
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
+    used = Column(Boolean, default=False, server_default='0', nullable=False)
+    revoked = Column(Boolean, default=False, server_default='0', nullable=False)
+    time = Column(TIMESTAMP(timezone=True), server_default=text('CURRENT_TIMESTAMP'), nullable=False)
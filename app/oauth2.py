@@ -1,10 +1,14 @@
+import hashlib
+import secrets
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from . import schemas, database, models
-from fastapi import Depends, status, HTTPException
+from fastapi import Depends, Request, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, event, false, true
+from sqlalchemy.ext.asyncio import AsyncSession
 from .config import settings
+from .cache import TTLCache
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 
@@ -17,36 +21,174 @@ SECRET_KEY =  settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+class JoseBackend:
+    errors = (JWTError,)
+
+    def encode(self, claims: dict, key: str, algorithm: str):
+        return jwt.encode(claims, key, algorithm=algorithm)
+
+    def decode(self, token: str, key: str, algorithm: str):
+        return jwt.decode(token, key, algorithms=[algorithm])
+
+class PyJWTBackend:
+    # optional, needs `pip install pyjwt`
+    def __init__(self):
+        import jwt as pyjwt
+        self.pyjwt = pyjwt
+        self.errors = (pyjwt.PyJWTError,)
+
+    def encode(self, claims: dict, key: str, algorithm: str):
+        return self.pyjwt.encode(claims, key, algorithm=algorithm)
+
+    def decode(self, token: str, key: str, algorithm: str):
+        return self.pyjwt.decode(token, key, algorithms=[algorithm])
+
+JWT_BACKENDS = {"jose": JoseBackend, "pyjwt": PyJWTBackend}
+
+jwt_backend = JWT_BACKENDS[settings.jwt_backend]()
+
+# sha256(token) -> schemas.TokenData, never kept past the token's exp
+token_cache = TTLCache(maxsize=settings.token_cache_size, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+# user_id -> schemas.CurrentUser, so authenticated requests don't all hit the users table
+principal_cache = TTLCache(maxsize=settings.principal_cache_size, ttl=settings.principal_cache_ttl)
+
+# refresh token family ("sid" in access tokens) -> revoked?, so checking an access token against
+# logouts costs one query per family per revocation_cache_ttl; other workers see a revocation
+# within that ttl
+revocation_cache = TTLCache(maxsize=settings.revocation_cache_size, ttl=settings.revocation_cache_ttl)
+
 def create_access_token(data: dict):
     to_encode = data.copy()
 
     expire = datetime.utcnow() + timedelta(minutes = ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
 
-    encode_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encode_jwt = jwt_backend.encode(to_encode, SECRET_KEY, ALGORITHM)
 
     return encode_jwt
 
 def verfiy_access_token(token: str, credentials_exception):
+    cache_key = hashlib.sha256(token.encode()).digest()
+    token_data = token_cache.get(cache_key)
+    if token_data is not None:
+        return token_data
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt_backend.decode(token, SECRET_KEY, ALGORITHM)
 
         id = payload.get("user_id")
 
         if id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(id=id)
-    except JWTError:
+        token_data = schemas.TokenData(id=id, exp=payload.get("exp"), sid=payload.get("sid"))
+    except jwt_backend.errors:
         raise credentials_exception
-    
+
+    token_cache.set(cache_key, token_data, expires_at=token_data.exp)
+
     return token_data
     
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+def client_key(request: Request):
+    # who read-your-writes stickiness applies to: the user of a valid bearer token, so it carries
+    # over to the next access token, or else the client's address
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            return f"user:{verfiy_access_token(token, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)).id}"
+        except HTTPException:
+            pass
+    return request.client.host if request.client else None
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"could not validate credentials",
                                           headers={"WWW-Authenticate": "Bearer"})
     
     token = verfiy_access_token(token, credentials_exception)
 
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+    # checked in claims-only mode too, from revocation_cache, so a logout still ends the session
+    if token.sid is not None and await session_revoked(db, token.sid):
+        raise credentials_exception
+
+    if settings.auth_claims_only:
+        # trust the signed claims; a deleted user keeps access until the token expires
+        return schemas.CurrentUser(id=token.id)
+
+    user = principal_cache.get(int(token.id))
+    if user is None:
+        result = await db.execute(select(models.User).filter(models.User.id == token.id))
+        db_user = result.scalars().first()
+        if db_user is None:
+            raise credentials_exception
+        user = schemas.CurrentUser.from_orm(db_user)
+        principal_cache.set(user.id, user, expires_at=token.exp)
+
+    return user
+
+# Refresh tokens are opaque random strings, stored hashed and used once: each refresh marks the
+# token used and issues the next one in its family. A used token coming back means it leaked, so
+# the whole family is revoked.
+
+def hash_refresh_token(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def insert_refresh_token(session, user_id: int, family: str):
+    token = secrets.token_urlsafe(32)
+    session.execute(insert(models.RefreshToken).values(token_hash=hash_refresh_token(token), family=family, user_id=user_id,
+                                                       expires_at=datetime.utcnow() + timedelta(days=settings.refresh_token_expire_days)))
+    return token
+
+def as_utc(moment: datetime):
+    # MySQL and SQLite hand TIMESTAMPs back without an offset; they are stored in UTC
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+def create_refresh_token(session, user_id: int):
+    family = secrets.token_hex(16)
+    token = insert_refresh_token(session, user_id, family)
+    session.commit()
+    return token, family
+
+def revoke_family(session, family: str):
+    session.execute(update(models.RefreshToken).filter(models.RefreshToken.family == family).values(revoked=True))
+    session.commit()
+    revocation_cache.set(family, True)
+
+def rotate_refresh_token(session, token: str):
+    invalid = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    row = session.execute(select(models.RefreshToken.id, models.RefreshToken.user_id, models.RefreshToken.family,
+                                 models.RefreshToken.expires_at, models.RefreshToken.used, models.RefreshToken.revoked)
+                          .filter(models.RefreshToken.token_hash == hash_refresh_token(token))).first()
+    if row is None or row.revoked or as_utc(row.expires_at) <= datetime.now(timezone.utc):
+        raise invalid
+    if row.used:
+        revoke_family(session, row.family)
+        raise invalid
+    # conditional, so of two requests presenting the same token only one rotates it
+    result = session.execute(update(models.RefreshToken).filter(models.RefreshToken.id == row.id, models.RefreshToken.used == false())
+                             .values(used=True))
+    if result.rowcount == 0:
+        session.rollback()
+        revoke_family(session, row.family)
+        raise invalid
+    new_token = insert_refresh_token(session, row.user_id, row.family)
+    session.commit()
+    return row.user_id, row.family, new_token
+
+def revoke_refresh_token(session, token: str):
+    family = session.scalar(select(models.RefreshToken.family).filter(models.RefreshToken.token_hash == hash_refresh_token(token)))
+    if family is not None:
+        revoke_family(session, family)
+
+async def session_revoked(db: AsyncSession, family: str):
+    revoked = revocation_cache.get(family)
+    if revoked is None:
+        result = await db.execute(select(models.RefreshToken.id)
+                                  .filter(models.RefreshToken.family == family, models.RefreshToken.revoked == true()).limit(1))
+        revoked = result.first() is not None
+        revocation_cache.set(family, revoked)
+    return revoked
 
-    return user
\ No newline at end of file
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def invalidate_principal(mapper, connection, target):
+    principal_cache.pop(target.id)
\ No newline at end of file
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import threading
+from urllib.parse import urlencode
+from fastapi import Request, Response
+from .cache import TTLCache
+from .config import settings
+
+# Cached GET responses for the post routes. Entries are tagged with what they were built from:
+#   "posts"      every listing (a new or deleted post can move any page)
+#   "search"     listings with a search term (an edit can change what matches)
+#   "post:<id>"  the detail response and every listing that contains that post
+# and the write paths invalidate exactly the tags they affect.
+#
+# Each backend also keeps a generation, bumped by every invalidation. A response is only stored
+# if the generation is still the one read before it was computed, so a response built from data a
+# write has since changed isn't cached after that write's invalidation. The redis generation is
+# shared, so this holds across workers too.
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int, ttl: int):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.tags = {}
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    async def get(self, key: str):
+        return self.entries.get(key)
+
+    async def begin(self):
+        return self.generation
+
+    async def set(self, key: str, value: bytes, tags, started: int):
+        with self._lock:
+            if started != self.generation:
+                return
+            self.entries.set(key, value)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            # drop tag references to entries the LRU has already evicted
+            if len(self.tags) > 10 * max(self.entries.maxsize, 1):
+                self.tags = {tag: keys & self.entries.keys() for tag, keys in self.tags.items()}
+                self.tags = {tag: keys for tag, keys in self.tags.items() if keys}
+
+    async def invalidate(self, tags):
+        with self._lock:
+            self.generation += 1
+            keys = set().union(*(self.tags.pop(tag, set()) for tag in tags))
+        for key in keys:
+            self.entries.pop(key)
+
+    async def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags = {}
+
+    def stats(self):
+        return {"backend": "memory", **self.entries.stats()}
+
+
+class RedisBackend:
+    # shared by every worker; needs `pip install redis`
+    def __init__(self, url: str, ttl: int, prefix: str = "response-cache:"):
+        import redis.asyncio as redis
+        from redis.exceptions import WatchError
+        self.client = redis.from_url(url)
+        self.watch_error = WatchError
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation_key = prefix + "generation"
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        value = await self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def begin(self):
+        return int(await self.client.get(self.generation_key) or 0)
+
+    async def set(self, key: str, value: bytes, tags, started: int):
+        # WATCH makes the write fail if another worker invalidated (bumped the generation) between
+        # the check and the EXEC
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.generation_key)
+                if int(await pipe.get(self.generation_key) or 0) != started:
+                    return
+                pipe.multi()
+                pipe.set(self.prefix + key, value, ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(f"{self.prefix}tag:{tag}", self.prefix + key)
+                    pipe.expire(f"{self.prefix}tag:{tag}", self.ttl)
+                await pipe.execute()
+            except self.watch_error:
+                pass
+
+    async def invalidate(self, tags):
+        # the generation goes up before the entries go, so a response computed before this call
+        # can't be stored once it returns
+        await self.client.incr(self.generation_key)
+        tag_keys = [f"{self.prefix}tag:{tag}" for tag in tags]
+        keys = await self.client.sunion(*tag_keys)
+        await self.client.delete(*keys, *tag_keys)
+
+    async def clear(self):
+        # the generation is bumped rather than deleted, so it never goes back to a value already read
+        await self.client.incr(self.generation_key)
+        keys = [key async for key in self.client.scan_iter(match=self.prefix + "*") if key.decode() != self.generation_key]
+        if keys:
+            await self.client.delete(*keys)
+
+    def stats(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+def make_backend(name: str):
+    if name == "memory":
+        return MemoryBackend(maxsize=settings.response_cache_size, ttl=settings.response_cache_ttl)
+    if name == "redis":
+        return RedisBackend(settings.redis_url, ttl=settings.response_cache_ttl)
+    return None
+
+
+backend = make_backend(settings.response_cache_backend)
+
+
+def make_key(route: str, **params):
+    return f"{route}?{urlencode(sorted((name, value) for name, value in params.items() if value not in (None, '')))}"
+
+
+async def begin():
+    return await backend.begin() if backend is not None else None
+
+
+async def lookup(key: str):
+    if backend is None:
+        return None
+    value = await backend.get(key)
+    return json.loads(value) if value is not None else None
+
+
+async def store(key: str, entry: dict, tags, started: int):
+    if backend is None:
+        return
+    await backend.set(key, json.dumps(entry).encode(), tags, started)
+
+
+async def invalidate(*tags):
+    if backend is not None:
+        await backend.invalidate(tags)
+
+
+async def clear():
+    if backend is not None:
+        await backend.clear()
+
+
+def stats():
+    return backend.stats() if backend is not None else {"backend": "none"}
+
+
+def make_entry(body: bytes, headers: dict = None, version: int = None):
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    # a single post's tag leads with its version, so the same tag works as If-Match for an edit
+    if version is not None:
+        etag = f"{version}.{etag}"
+    return {"body": body.decode(), "etag": f'"{etag}"', "headers": headers or {}}
+
+
+def respond(request: Request, entry: dict):
+    headers = {"ETag": entry["etag"], **entry["headers"]}
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry["etag"] in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
@@ -1,28 +1,47 @@
 from fastapi import APIRouter, Depends, status, HTTPException, Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from .. import database, schemas, models, utils, oauth2
 
 
-router = APIRouter(tags=["Authentication"])
+router = APIRouter(tags=["Authentication"], route_class=database.SessionReleasingRoute)
  
 @router.post('/login', response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_db)):
 
     # OAuth2PasswordRequestForm only return username(email), and password
-    user = db.query(models.User).filter(models.User.email == user_credentials.username).first()
+    result = await db.execute(select(models.User).filter(models.User.email == user_credentials.username))
+    user = result.scalars().first()
 
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credentials")
     
-    if not utils.verify(user_credentials.password, user.password):
+    if not await utils.verify_async(user_credentials.password, user.password):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credentials")
     
     # create a token
     # return token
 
-    access_token = oauth2.create_access_token(data={"user_id": user.id})
+    refresh_token, family = await db.run_sync(oauth2.create_refresh_token, user.id)
+    access_token = oauth2.create_access_token(data={"user_id": user.id, "sid": family})
 
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@router.post('/token/refresh', response_model=schemas.Token)
+async def refresh(body: schemas.RefreshRequest, db: AsyncSession = Depends(database.get_db)):
+    # a new access token without the password, so no bcrypt
+    user_id, family, refresh_token = await db.run_sync(oauth2.rotate_refresh_token, body.refresh_token)
+    access_token = oauth2.create_access_token(data={"user_id": user_id, "sid": family})
+
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@router.post('/token/revoke', status_code=status.HTTP_204_NO_CONTENT)
+async def revoke(body: schemas.RefreshRequest, db: AsyncSession = Depends(database.get_db)):
+    # logs the session out: its refresh tokens stop working and so do its access tokens, within
+    # REVOCATION_CACHE_TTL on other workers; an unknown token is not an error
+    await db.run_sync(oauth2.revoke_refresh_token, body.refresh_token)
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -0,0 +1,94 @@
+import bisect
+import threading
+from fastapi import APIRouter
+from .. import oauth2, database, response_cache, vote_buffer, vote_stream
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["Metrics"]
+)
+
+class Histogram:
+    # cumulative counts per upper bound, Prometheus style
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def summary(self):
+        buckets, running = {}, 0
+        for bound, count in zip([*self.bounds, "+Inf"], self.counts):
+            running += count
+            buckets[str(bound)] = running
+        return {"sum": round(self.total, 3), "max": round(self.max, 3), "buckets": buckets}
+
+class RouteMetrics:
+    QUERY_BOUNDS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+    DB_MS_BOUNDS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def _route(self, route: str):
+        # caller holds self._lock
+        metrics = self.routes.get(route)
+        if metrics is None:
+            metrics = self.routes[route] = {"requests": 0, "queries": Histogram(self.QUERY_BOUNDS),
+                                            "db_ms": Histogram(self.DB_MS_BOUNDS), "slowest": None,
+                                            "session_ms": Histogram(self.DB_MS_BOUNDS), "session_saved_ms": Histogram(self.DB_MS_BOUNDS)}
+        return metrics
+
+    def observe(self, route: str, stats):
+        with self._lock:
+            metrics = self._route(route)
+            metrics["requests"] += 1
+            metrics["queries"].observe(stats.count)
+            metrics["db_ms"].observe(stats.seconds * 1000)
+            if stats.slowest_statement and (metrics["slowest"] is None or stats.slowest_seconds * 1000 > metrics["slowest"]["ms"]):
+                metrics["slowest"] = {"ms": round(stats.slowest_seconds * 1000, 3), "statement": " ".join(stats.slowest_statement.split())}
+
+    def observe_session(self, route: str, open_seconds: float, saved_seconds: float):
+        # recorded at the end of the request, after observe(): how long a session stayed open, and
+        # how much of the rest of the request it would have held a connection for without the early release
+        with self._lock:
+            metrics = self._route(route)
+            metrics["session_ms"].observe(open_seconds * 1000)
+            metrics["session_saved_ms"].observe(saved_seconds * 1000)
+
+    def clear(self):
+        with self._lock:
+            self.routes = {}
+
+    def summary(self):
+        with self._lock:
+            return {route: {"requests": metrics["requests"], "queries": metrics["queries"].summary(),
+                            "db_ms": metrics["db_ms"].summary(), "slowest": metrics["slowest"],
+                            "session_ms": metrics["session_ms"].summary(), "session_saved_ms": metrics["session_saved_ms"].summary()}
+                    for route, metrics in sorted(self.routes.items())}
+
+route_metrics = RouteMetrics()
+
+@router.get("/")
+async def get_metrics():
+    principal_cache = oauth2.principal_cache.stats()
+    # every hit is a SELECT on users that didn't happen
+    principal_cache["db_lookups_saved"] = principal_cache["hits"]
+
+    return {
+        "principal_cache": principal_cache,
+        "token_cache": oauth2.token_cache.stats(),
+        "revocation_cache": oauth2.revocation_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "pool": database.pool_status(database.active_engine().pool),
+        "replicas": database.replica_router.status(),
+        "routes": route_metrics.summary(),
+        "vote_buffer": vote_buffer.buffer.stats() if vote_buffer.buffer is not None else None,
+        "vote_stream": vote_stream.broker.stats() if vote_stream.broker is not None else None,
+    }
@@ -1,73 +1,521 @@
-from fastapi import status, Response, HTTPException, Depends, APIRouter
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from ..database import get_db
-from .. import models, schemas, oauth2
-from typing import List, Optional
+import asyncio
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+import orjson
+from fastapi import status, Body, Header, Query, Request, Response, HTTPException, Depends, APIRouter, WebSocket
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import exists, false, func, select, insert, update, delete, text
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from ..database import get_db, get_read_db, SessionReleasingRoute
+from .. import models, schemas, oauth2, search, response_cache, serializers, vote_stream
+from ..config import settings
+from typing import Any, List, Optional, Literal, Union
 
 router = APIRouter(
     prefix="/posts",
-    tags = ['Posts']
+    tags = ['Posts'],
+    route_class=SessionReleasingRoute
 )
 
+# PostOut nests the owner, so it is loaded with the posts instead of one lazy SELECT per post
+# (lazy loads can't run on an AsyncSession anyway). "joined" adds a JOIN to the query,
+# "selectin" issues one extra SELECT ... WHERE users.id IN (...) for the whole page.
+OWNER_LOADERS = {"joined": joinedload, "selectin": selectinload}
+
+def load_owner(strategy: str):
+    return OWNER_LOADERS[strategy](models.Post.owner)
+
+def voted_by(user_id: Optional[int]):
+    if user_id is None:
+        # a response shared through the response cache; respond_voted fills in the user's votes
+        return false().label("voted")
+    # a probe of votes' (user_id, post_id) primary key per row, inside the query that reads the
+    # posts, so a page costs no extra statement
+    return exists().where(models.Vote.user_id == user_id, models.Vote.post_id == models.Post.id).label("voted")
+
+def post_out_columns(user_id: Optional[int]):
+    # the row serializers.post_out expects
+    return models.Post, models.Post.votes_count.label("votes"), voted_by(user_id)
+
+def voted_reader(user_id: int):
+    # cached responses are shared by every user, so the user's votes are read per request
+    # instead of inside the cached query
+    return None if response_cache.backend is not None else user_id
+
+# voted is the last key of every rendered post
+VOTED_FALSE = '"voted":false}'
+
+def shared_entry(items: list, ids: list, headers: dict = None, many: bool = True, version: int = None, voted: bool = False):
+    # what the response cache keeps for the post routes: each post rendered on its own, exactly as
+    # FastAPI would render the response model, so voted can be flipped without parsing the body again
+    return {"items": [serializers.render(item).decode() for item in items], "ids": ids, "headers": headers or {},
+            "many": many, "version": version, "voted": voted}
+
+async def respond_voted(request: Request, db: AsyncSession, shared: dict, user_id: int):
+    items = shared["items"]
+    if shared["voted"] and items:
+        result = await db.execute(select(models.Vote.post_id).filter(models.Vote.user_id == user_id, models.Vote.post_id.in_(shared["ids"])))
+        voted = set(result.scalars())
+        items = [item[:-len(VOTED_FALSE)] + '"voted":true}' if post_id in voted else item for item, post_id in zip(items, shared["ids"])]
+    body = f"[{','.join(items)}]" if shared["many"] else items[0]
+    return response_cache.respond(request, response_cache.make_entry(body.encode(), shared["headers"], shared["version"]))
+
+def parse_fields(fields: Optional[str]):
+    if fields is None:
+        return schemas.SPARSE_POST_FIELDS
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names.difference(schemas.SPARSE_POST_FIELDS)
+    if unknown or not names:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"fields takes a comma separated list of: {', '.join(schemas.SPARSE_POST_FIELDS)}")
+    return tuple(name for name in schemas.SPARSE_POST_FIELDS if name in names)
+
+def sparse_query(fields: tuple, content_preview: Optional[int], user_id: int):
+    # loads only the requested columns: content is deferred (or cut down to content_preview
+    # characters by the database) and the owner is only loaded if it was asked for
+    preview = content_preview is not None and "content" in fields
+    columns = [getattr(models.Post, name) for name in fields if name not in ("owner", "votes", "voted") and not (name == "content" and preview)]
+    entities = [models.Post]
+    if "votes" in fields:
+        entities.append(models.Post.votes_count.label("votes"))
+    if "voted" in fields:
+        entities.append(voted_by(user_id))
+    if preview:
+        entities.append(func.substr(models.Post.content, 1, content_preview).label("content_preview"))
+    options = [load_only(models.Post.id, *columns)]
+    if "owner" in fields:
+        options.append(load_owner(settings.post_list_owner_loading))
+    return select(*entities).options(*options), preview
+
+def encode_cursor(position: dict):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor: str):
+    # {"id": last seen post id} for the newest-first listing, {"after": last seen post id} for the
+    # oldest-first one, {"offset": n} for ranked search results
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {key: int(position[key]) for key in ("id", "after", "offset") if key in position}
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+async def search_posts(db: AsyncSession, query, search_text: str, offset: int, limit: int):
+    if settings.search_backend == "memory":
+        matches = await run_in_threadpool(search.search_index.search, search_text, offset + limit)
+        ids = [post_id for post_id, score in matches[offset:]]
+        result = await db.execute(query.filter(models.Post.id.in_(ids)))
+        rows = {row.Post.id: row for row in result.all()}
+        return [rows[post_id] for post_id in ids if post_id in rows]
+
+    relevance = match(models.Post.title, models.Post.content, against=search_text)
+    result = await db.execute(query.filter(relevance).order_by(relevance.desc(), models.Post.id.desc()).limit(limit).offset(offset))
+    return result.all()
+
 # @router.get("/", response_model=List[schemas.Post])
-@router.get("/", response_model=List[schemas.PostOut])
-async def get_post(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), 
-                   limit: int = 10, skip: int = 0, search: Optional[str] = ""):
+# with fields= or content_preview= the items are SparsePostOut, holding only what was asked for
+@router.get("/", response_model=Union[List[schemas.PostOut], List[schemas.SparsePostOut]])
+async def get_post(request: Request, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user), 
+                   limit: int = 10, skip: int = 0, search: Optional[str] = "", cursor: Optional[str] = None,
+                   fields: Optional[str] = None, content_preview: Optional[int] = Query(None, ge=0)):
     # posts_dict = db.get_all_data_as_JSON(table_name=table_name)
     # posts_dict = db.query(models.Post).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
 
-    result = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
-    return result
+    sparse = parse_fields(fields) if fields is not None or content_preview is not None else None
+    position = decode_cursor(cursor) if cursor else {}
+    # skip pages keep the listing's original oldest-first order, and so do the cursors they hand
+    # out; paging by cursor from the start (an empty ?cursor=) goes newest first
+    newest_first = cursor is not None and "after" not in position
+    cache_key = response_cache.make_key("posts", limit=limit, skip=skip, search=search, cursor=cursor, newest=int(newest_first),
+                                         fields=",".join(sparse) if sparse else None, content_preview=content_preview)
+    cached = await response_cache.lookup(cache_key)
+    if cached:
+        return await respond_voted(request, db, cached, current_user.id)
+    started = await response_cache.begin()
+
+    voter = voted_reader(current_user.id)
+    if sparse is None:
+        query = select(*post_out_columns(voter)).options(load_owner(settings.post_list_owner_loading))
+    else:
+        query, preview = sparse_query(sparse, content_preview, voter)
+
+    if search and settings.search_backend in ("memory", "fulltext"):
+        # relevance ranked, so pages are addressed by offset
+        offset = position.get("offset", skip)
+        posts = await search_posts(db, query, search, offset, limit)
+        next_position = {"offset": offset + limit}
+    else:
+        query = query.filter(models.Post.title.contains(search)).limit(limit)
+
+        # a cursor seeks straight to the last seen id instead of scanning `skip` rows
+        if newest_first:
+            query = query.order_by(models.Post.id.desc())
+            if "id" in position:
+                query = query.filter(models.Post.id < position["id"])
+        else:
+            query = query.order_by(models.Post.id)
+            if "after" in position:
+                query = query.filter(models.Post.id > position["after"])
+            else:
+                query = query.offset(skip)
+
+        result = await db.execute(query)
+        posts = result.all()
+        next_position = {"id" if newest_first else "after": posts[-1].Post.id} if posts else None
+
+    headers = {}
+    if limit > 0 and len(posts) == limit:
+        headers["X-Next-Cursor"] = encode_cursor(next_position)
+
+    if sparse is None:
+        content = [serializers.post_out(post) for post in posts]
+    else:
+        content = [serializers.sparse_post_out(post, sparse, preview) for post in posts]
+    shared = shared_entry(content, [post.Post.id for post in posts], headers,
+                          voted=voter is None and (sparse is None or "voted" in sparse))
+    tags = ["posts", *(f"post:{post.Post.id}" for post in posts)] + (["search"] if search else [])
+    await response_cache.store(cache_key, shared, tags, started)
+
+    return await respond_voted(request, db, shared, current_user.id)
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.Post)
-async def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def create_posts(post: schemas.PostCreate, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
     # data = {"title": post.title, "content": post.content, "published": post.published}
     # new_post = db.insert_data(table_name=table_name, data=data)
     
     new_post = models.Post(owner_id=current_user.id, **post.dict())
     db.add(new_post)
-    db.commit()
-    db.refresh(new_post)
+    await db.commit()
+    await db.refresh(new_post, ["owner"])
+    search.index_post(new_post)
+    await response_cache.invalidate("posts")
 
     return new_post
 
+BULK_INSERT_CHUNK = 100
+
+def insert_posts(session, owner_id: int, posts: List[dict]):
+    # multi-row INSERTs of BULK_INSERT_CHUNK rows (4 parameters each, under SQLite's old 999 limit),
+    # committed together
+    table = models.Post.__table__
+    returning = session.get_bind().dialect.insert_returning
+    if not returning:
+        # MySQL reports the first id of a multi-row INSERT, and InnoDB gives the rows of an
+        # INSERT ... VALUES ids auto_increment_increment apart (more than 1 on multi-primary setups)
+        step = session.execute(text("SELECT @@auto_increment_increment")).scalar()
+    ids = []
+    for start in range(0, len(posts), BULK_INSERT_CHUNK):
+        rows = [{"owner_id": owner_id, **post} for post in posts[start:start + BULK_INSERT_CHUNK]]
+        if returning:
+            ids.extend(session.scalars(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows))
+        else:
+            result = session.execute(insert(table).values(rows))
+            ids.extend(range(result.lastrowid, result.lastrowid + len(rows) * step, step))
+    session.commit()
+    return ids
+
+def too_large():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"at most {settings.post_bulk_max_items} posts or {settings.post_bulk_max_bytes} bytes per request")
+
+class BulkBodyRoute(SessionReleasingRoute):
+    # FastAPI parses the whole body before the endpoint runs, so its size is capped while it is
+    # read instead, by counting what the ASGI receive hands over (FastAPI lets the HTTPException
+    # through from there); the item count is checked once it is parsed
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def limited(request: Request):
+            limit = settings.post_bulk_max_bytes
+            if int(request.headers.get("content-length") or 0) > limit:
+                raise too_large()
+            received = 0
+
+            async def receive():
+                nonlocal received
+                message = await request.receive()
+                if message["type"] == "http.request":
+                    received += len(message.get("body", b""))
+                    if received > limit:
+                        raise too_large()
+                return message
+            return await handler(Request(request.scope, receive))
+        return limited
+
+async def create_posts_bulk(response: Response, items: List[Any] = Body(...), db: AsyncSession = Depends(get_db),
+                            current_user: int = Depends(oauth2.get_current_user)):
+    if len(items) > settings.post_bulk_max_items:
+        raise too_large()
+
+    # items are validated one by one so a bad item is reported by its index instead of failing the request
+    results = [schemas.PostBulkItem(index=index) for index in range(len(items))]
+    valid = []
+    for result, item in zip(results, items):
+        try:
+            valid.append((result, schemas.PostCreate.parse_obj(item)))
+        except ValidationError as error:
+            result.errors = error.errors()
+
+    if valid:
+        ids = await db.run_sync(insert_posts, current_user.id, [post.dict() for result, post in valid])
+        for (result, post), post_id in zip(valid, ids):
+            result.id = post_id
+            search.index_post(models.Post(id=post_id, **post.dict()))
+        await response_cache.invalidate("posts")
+    else:
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    return schemas.PostBulkOut(created=len(valid), failed=len(items) - len(valid), items=results)
+
+# declared before /{id} so "bulk" and "batch" aren't taken for post ids
+router.add_api_route("/bulk", create_posts_bulk, methods=["POST"], status_code=status.HTTP_201_CREATED,
+                     response_model=schemas.PostBulkOut, route_class_override=BulkBodyRoute)
+
+@router.get("/batch", response_model=List[schemas.PostOut])
+async def get_posts_batch(request: Request, ids: str, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
+    try:
+        requested = list(dict.fromkeys(int(post_id) for post_id in ids.split(",") if post_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids must be a comma separated list of post ids")
+    if len(requested) > settings.post_batch_max_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"at most {settings.post_batch_max_ids} ids per request")
+
+    cache_key = response_cache.make_key("posts:batch", ids=",".join(map(str, requested)))
+    cached = await response_cache.lookup(cache_key)
+    if cached:
+        return await respond_voted(request, db, cached, current_user.id)
+    started = await response_cache.begin()
+
+    # one query for every post, its owner, its vote count and the user's vote, whatever the number of ids
+    voter = voted_reader(current_user.id)
+    result = await db.execute(select(*post_out_columns(voter)).filter(models.Post.id.in_(requested))
+                              .options(joinedload(models.Post.owner)))
+    rows = {row.Post.id: row for row in result.all()}
+    # in the requested order; ids that don't exist are left out
+    posts = [rows[post_id] for post_id in requested if post_id in rows]
+
+    shared = shared_entry([serializers.post_out(post) for post in posts], [post.Post.id for post in posts], voted=voter is None)
+    tags = [f"post:{post_id}" for post_id in requested] + (["posts"] if len(posts) < len(requested) else [])
+    await response_cache.store(cache_key, shared, tags, started)
+
+    return await respond_voted(request, db, shared, current_user.id)
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CSV_COLUMNS = ["id", "title", "content", "published", "time", "owner_id", "owner_email", "votes", "voted"]
+
+async def export_chunks(db: AsyncSession, query, format: str, batch_size: int = 1000):
+    # yield_per reads through a server-side cursor one batch at a time, and StreamingResponse only asks
+    # for the next batch once the client has taken the previous one, so memory stays flat however
+    # many rows match and a slow client slows the cursor down rather than buffering
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    try:
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_CSV_COLUMNS)
+            yield buffer.getvalue().encode()
+        async for rows in result.partitions():
+            if format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows([row.Post.id, row.Post.title, row.Post.content, row.Post.published, row.Post.time.isoformat(),
+                                  row.Post.owner_id, row.Post.owner.email, row.votes, bool(row.voted)] for row in rows)
+                yield buffer.getvalue().encode()
+            else:
+                yield b"".join(orjson.dumps({"Post": serializers.post(row.Post), "votes": row.votes, "voted": bool(row.voted)}) + b"\n" for row in rows)
+    finally:
+        await result.close()
+
+# declared before /{id} so "export" isn't taken for a post id
+@router.get("/export")
+async def export_posts(db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user),
+                       format: Literal["ndjson", "csv"] = "ndjson", published: Optional[bool] = None, owner_id: Optional[int] = None,
+                       since: Optional[datetime] = None, until: Optional[datetime] = None, after_id: int = 0):
+    # oldest first by id, so an interrupted export can carry on with after_id=<last id received>
+    query = (select(*post_out_columns(current_user.id)).options(joinedload(models.Post.owner))
+             .filter(models.Post.id > after_id).order_by(models.Post.id))
+    if published is not None:
+        query = query.filter(models.Post.published == published)
+    if owner_id is not None:
+        query = query.filter(models.Post.owner_id == owner_id)
+    if since is not None:
+        query = query.filter(models.Post.time >= since)
+    if until is not None:
+        query = query.filter(models.Post.time < until)
+
+    return StreamingResponse(export_chunks(db, query, format), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="posts.{format}"'})
+
 @router.get("/{id}", response_model=schemas.PostOut)
-async def get_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def get_post(id: int, request: Request, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
     # posts_dict = db.get_data_by_id_as_JSON(table_name=table_name, id=id)
     
     # posts_dict = db.query(models.Post).filter(models.Post.id == id).first()
 
-    posts_dict = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(models.Post.id == id).first()
+    cache_key = response_cache.make_key(f"post:{id}")
+    cached = await response_cache.lookup(cache_key)
+    if cached:
+        return await respond_voted(request, db, cached, current_user.id)
+    started = await response_cache.begin()
+
+    voter = voted_reader(current_user.id)
+    result = await db.execute(select(*post_out_columns(voter)).filter(models.Post.id == id)
+                              .options(load_owner(settings.post_detail_owner_loading)))
+    posts_dict = result.first()
     
     if not posts_dict:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
                             detail=f"post with {id} was not found")
-    
-    return posts_dict
 
-@router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_post(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # delete_post = db.delete_data_by_id(table_name, (id,))
+    shared = shared_entry([serializers.post_out(posts_dict)], [id], many=False, version=posts_dict.Post.version, voted=voter is None)
+    await response_cache.store(cache_key, shared, [f"post:{id}"], started)
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
+    return await respond_voted(request, db, shared, current_user.id)
 
-    post = post_query.first()
+def vote_event(post_id: int, votes: Optional[int]):
+    if votes is None:
+        # a comment line, which EventSource ignores; keeps proxies from closing an idle stream
+        return b": keepalive\n\n"
+    return f"event: votes\ndata: {json.dumps({'post_id': post_id, 'votes': votes})}\n\n".encode()
 
-    if post is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail=f"post with ID: {id} does not exist")
+async def vote_events(broker, subscription):
+    try:
+        async for votes in vote_stream.updates(subscription):
+            yield vote_event(subscription.post_id, votes)
+    finally:
+        broker.unsubscribe(subscription)
+
+async def follow_votes(db: AsyncSession, id: int):
+    broker = vote_stream.broker
+    if broker is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vote streams are disabled")
+    if broker.full():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many vote streams, try again later",
+                            headers={"Retry-After": "5"})
+    # subscribed before the count is read, so a vote in between isn't missed
+    subscription = broker.subscribe(id)
+    counted = (await db.execute(select(models.Post.votes_count, models.Post.votes_seq).filter(models.Post.id == id))).first()
+    if counted is None:
+        broker.unsubscribe(subscription)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"post with {id} was not found")
+    # a newer count may already have arrived
+    subscription.offer(*counted)
+    return broker, subscription
+
+@router.get("/{id}/votes/stream")
+async def stream_votes(id: int, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
+    # Server-Sent Events: the post's vote count now and whenever it changes. The session is released
+    # when this returns, so an open stream holds no database connection.
+    broker, subscription = await follow_votes(db, id)
+    return StreamingResponse(vote_events(broker, subscription), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             # if the client is gone before the stream starts, its generator never runs
+                             background=BackgroundTask(broker.unsubscribe, subscription))
+
+@router.websocket("/{id}/votes/ws")
+async def vote_socket(websocket: WebSocket, id: int, token: str = "", db: AsyncSession = Depends(get_db)):
+    # the same updates as /votes/stream, as JSON messages; browsers can't set headers on a
+    # WebSocket, so the access token comes as ?token=
+    try:
+        await oauth2.get_current_user(token, db)
+        broker, subscription = await follow_votes(db, id)
+    except HTTPException as error:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(error.detail))
+        return
+    finally:
+        # WebSocket routes aren't wrapped by SessionReleasingRoute
+        await db.release()
 
-    if post.owner_id != current_user.id:
+    async def send():
+        async for votes in vote_stream.updates(subscription):
+            if votes is not None:
+                await websocket.send_json({"post_id": id, "votes": votes})
+
+    async def receive():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    await websocket.accept()
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        broker.unsubscribe(subscription)
+    # the stream reached VOTE_STREAM_MAX_SECONDS (or failed) rather than the client leaving
+    if tasks[0] in done:
+        tasks[0].result()
+        await websocket.close()
+
+def parse_if_match(if_match: Optional[str]):
+    # If-Match carries the post's version as returned in its body, e.g. If-Match: "3", or the ETag of
+    # GET /posts/{id}, "3.<hash>"; only the version is compared, so a vote since doesn't fail the edit
+    if if_match is None or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"').split(".")[0])
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="If-Match must be a post version or ETag")
+
+def owned_post_filter(id: int, user_id: int, version: Optional[int]):
+    conditions = [models.Post.id == id, models.Post.owner_id == user_id]
+    if version is not None:
+        conditions.append(models.Post.version == version)
+    return conditions
+
+def explain_miss(session, id: int, user_id: int):
+    # a conditional write that matched nothing doesn't say which condition failed; only then is the
+    # post looked up to pick the status
+    session.rollback()
+    current = session.execute(select(models.Post.owner_id, models.Post.version).filter(models.Post.id == id)).first()
+    if current is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"post with ID: {id} does not exist")
+    if current.owner_id != user_id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform requested action")
-    
-    post_query.delete(synchronize_session=False)
-    db.commit()
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail=f"post {id} has changed, its current version is {current.version}")
+
+def delete_owned_post(session, id: int, user_id: int, version: Optional[int]):
+    result = session.execute(delete(models.Post).filter(*owned_post_filter(id, user_id, version)))
+    if result.rowcount == 0:
+        explain_miss(session, id, user_id)
+    session.commit()
+
+def update_owned_post(session, id: int, user_id: int, version: Optional[int], values: dict):
+    # concurrent editors don't lock the row: whoever writes first bumps the version and a writer
+    # still holding the old one gets 412
+    result = session.execute(update(models.Post).filter(*owned_post_filter(id, user_id, version))
+                             .values(**values, version=models.Post.version + 1))
+    if result.rowcount == 0:
+        explain_miss(session, id, user_id)
+    post = session.scalars(select(models.Post).filter(models.Post.id == id).options(joinedload(models.Post.owner))
+                           .execution_options(populate_existing=True)).one()
+    # copied out before the commit expires it
+    post = schemas.Post.from_orm(post)
+    session.commit()
+    return post
+
+@router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_post(id: int, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+                      if_match: Optional[str] = Header(None)):
+    # delete_post = db.delete_data_by_id(table_name, (id,))
+
+    await db.run_sync(delete_owned_post, id, current_user.id, parse_if_match(if_match))
+    search.remove_post(id)
+    await response_cache.invalidate("posts", f"post:{id}")
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router.put("/{id}", response_model=schemas.Post)
-async def update_post(id: int, updated_post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def update_post(id: int, updated_post: schemas.PostCreate, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+                      if_match: Optional[str] = Header(None)):
     # new_values = {
     #     "title": post.title,
     #     "content": post.content,
@@ -75,18 +523,17 @@ async def update_post(id: int, updated_post: schemas.PostCreate, db: Session = D
     # }
     # updated_post = db.update_value(table_name=table_name, new_values=new_values, id=id)
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
+    post = await db.run_sync(update_owned_post, id, current_user.id, parse_if_match(if_match), updated_post.dict())
+    search.index_post(post)
+    await response_cache.invalidate(f"post:{id}", "search")
 
-    post = post_query.first()
+    return post
 
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail=f"post with ID: {id} does not exist")
-    
-    if post.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform requested action")
-    
-    post_query.update(updated_post.dict(), synchronize_session=False)
-    db.commit()
+@router.patch("/{id}", response_model=schemas.Post)
+async def patch_post(id: int, changes: schemas.PostUpdate, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user),
+                     if_match: Optional[str] = Header(None)):
+    post = await db.run_sync(update_owned_post, id, current_user.id, parse_if_match(if_match), changes.dict(exclude_unset=True))
+    search.index_post(post)
+    await response_cache.invalidate(f"post:{id}", "search")
 
-    return post_query.first()
\ No newline at end of file
+    return post
@@ -1,30 +1,33 @@
 from fastapi import status, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_db, get_read_db, SessionReleasingRoute
 from .. import models, schemas, utils
 
 router = APIRouter(
     prefix="/users",
-    tags=['Users']
+    tags=['Users'],
+    route_class=SessionReleasingRoute
 )
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
-async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     
     #hash the password - user.password
-    hashed_password = utils.hash(user.password)
+    hashed_password = await utils.hash_async(user.password)
     user.password = hashed_password
     
     new_user = models.User(**user.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
 
     return new_user
 
 @router.get("/{id}", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
-async def get_user(id: int, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.id == id).first()
+async def get_user(id: int, db: AsyncSession = Depends(get_read_db)):
+    result = await db.execute(select(models.User).filter(models.User.id == id))
+    user = result.scalars().first()
     
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
@@ -1,32 +1,80 @@
 from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
-from .. import schemas, database, models, oauth2
-from sqlalchemy.orm import Session
+from .. import schemas, database, models, oauth2, response_cache, vote_buffer, vote_stream
+from sqlalchemy import insert, delete, select, update, exc
+from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(
     prefix = "/vote",
-    tags = ["Vote"]
+    tags = ["Vote"],
+    route_class = database.SessionReleasingRoute
 )
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_user: int = Depends(oauth2.get_current_user)):
-    
-    post = db.query(models.Post).filter(models.Post.id == vote.post_id).first()
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with {vote.post_id} does not exist")
+def apply_vote(session, post_id: int, user_id: int, direction: int, returning: bool = False):
+    # No SELECTs up front: the writes themselves say whether the post or the vote exists, so two
+    # concurrent votes can't both pass a check. Both directions write the posts row first
+    # (posts.votes_count is kept in step in the same transaction), which also locks it, so votes on
+    # one post queue up behind each other instead of deadlocking on InnoDB's foreign key locks.
+    # With returning, and a database that supports UPDATE ... RETURNING, the post's new
+    # (votes_count, votes_seq) is returned for the vote streams at no extra cost.
+    step = 1 if direction == 1 else -1
+    statement = (update(models.Post).filter(models.Post.id == post_id)
+                 .values(votes_count=models.Post.votes_count + step, votes_seq=models.Post.votes_seq + 1))
+    counted = None
+    if returning and session.get_bind().dialect.update_returning:
+        counted = session.execute(statement.returning(models.Post.votes_count, models.Post.votes_seq)).first()
+        found = counted is not None
+    else:
+        found = session.execute(statement).rowcount > 0
+    if not found:
+        session.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with {post_id} does not exist")
 
-    vote_query = db.query(models.Vote).filter(models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id)
-    found_vote = vote_query.first()
-    if (vote.dir==1):
-        if found_vote:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"user {current_user.id} has already voted on post {vote.post_id}")
-        new_vote = models.Vote(post_id = vote.post_id, user_id = current_user.id)
-        db.add(new_vote)
-        db.commit()
-        return {"message": "successfully added vote"}
+    if direction == 1:
+        try:
+            session.execute(insert(models.Vote).values(post_id=post_id, user_id=user_id))
+            session.commit()
+        except exc.IntegrityError as error:
+            session.rollback()
+            if database.is_duplicate_key(error):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"user {user_id} has already voted on post {post_id}")
+            if database.is_foreign_key_violation(error):
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with {post_id} does not exist")
+            raise
     else:
-        if not found_vote:
+        result = session.execute(delete(models.Vote).filter(models.Vote.post_id == post_id, models.Vote.user_id == user_id))
+        if result.rowcount == 0:
+            session.rollback()
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vote does not exist")
-        vote_query.delete(synchronize_session=False)
-        db.commit()
+        session.commit()
+    return tuple(counted) if counted is not None else None
 
-        return {"message": "successfully deleted vote"}
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def vote(vote: schemas.Vote, response: Response, db: AsyncSession = Depends(database.get_db), current_user: int = Depends(oauth2.get_current_user)):
+    buffer = vote_buffer.buffer
+    if buffer is not None:
+        # applied later in a batch, so repeats and missing posts can't be reported here
+        await buffer.add(vote.post_id, current_user.id, vote.dir)
+        if buffer.full():
+            await buffer.flush(db)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "vote queued"}
+
+    # the whole transaction is one run_sync call: in sync mode a vote holding the post's row lock
+    # never has to wait for a free threadpool thread (possibly all taken by votes queued on that
+    # same lock) before it can commit
+    broker = vote_stream.broker
+    counted = await db.run_sync(apply_vote, vote.post_id, current_user.id, vote.dir, broker is not None)
+    await response_cache.invalidate(f"post:{vote.post_id}")
+    if broker is not None:
+        # Without RETURNING the count is read after the commit, outside the row lock, and only if
+        # someone follows the post. A stream subscribes before reading its first count, so one that
+        # read before this commit is already subscribed here; votes_seq keeps a count read late from
+        # overwriting a newer one.
+        if counted is None and broker.wants(vote.post_id):
+            counted = (await db.execute(select(models.Post.votes_count, models.Post.votes_seq).filter(models.Post.id == vote.post_id))).first()
+        if counted is not None:
+            await broker.publish(vote.post_id, *counted)
+
+    if (vote.dir==1):
+        return {"message": "successfully added vote"}
+    return {"message": "successfully deleted vote"}
@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr
+import functools
+from pydantic import BaseModel, EmailStr, create_model, validator
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from pydantic.types import conint
 
 class UserOut(BaseModel):
@@ -24,10 +25,23 @@ class PostBase(BaseModel):
 class PostCreate(PostBase):
     pass
 
+class PostUpdate(BaseModel):
+    # PATCH body: only the fields that are sent are changed
+    title: Optional[str] = None
+    content: Optional[str] = None
+    published: Optional[bool] = None
+
+    @validator("title", "content", "published", pre=True)
+    def not_null(cls, value):
+        if value is None:
+            raise ValueError("may not be null")
+        return value
+
 class Post(PostBase):
     id: int
     time: datetime
     owner_id: int
+    version: int
     owner: UserOut
 
     class Config:
@@ -36,10 +50,44 @@ class Post(PostBase):
 class PostOut(BaseModel):
     Post: Post
     votes: int
+    # whether the authenticated user has voted on the post
+    voted: bool
 
     class Config:
         orm_mode = True
 
+# what GET /posts/?fields= can ask for: any field of Post, votes and voted
+SPARSE_POST_FIELDS = (*Post.__fields__, "votes", "voted")
+
+# the documented shape of a GET /posts/?fields= item: whatever wasn't asked for is left out
+SparsePost = create_model("SparsePost", **{field: (Optional[Post.__fields__[field].outer_type_], None) for field in Post.__fields__})
+
+class SparsePostOut(BaseModel):
+    Post: SparsePost
+    votes: Optional[int]
+    voted: Optional[bool]
+
+@functools.lru_cache(maxsize=None)
+def sparse_post_out(fields: tuple):
+    # PostOut cut down to `fields` (in SPARSE_POST_FIELDS order, so there is one model per combination)
+    name = ",".join(fields)
+    post = create_model(f"Post[{name}]", **{field: (Post.__fields__[field].outer_type_, ...) for field in fields if field in Post.__fields__})
+    out = {"Post": (post, ...)}
+    for field in ("votes", "voted"):
+        if field in fields:
+            out[field] = (PostOut.__fields__[field].outer_type_, ...)
+    return create_model(f"PostOut[{name}]", **out)
+
+class PostBulkItem(BaseModel):
+    index: int
+    id: Optional[int] = None
+    errors: Optional[List[Dict[str, Any]]] = None
+
+class PostBulkOut(BaseModel):
+    created: int
+    failed: int
+    items: List[PostBulkItem]
+
 class UserCreate(BaseModel):
     email: EmailStr
     password: str
@@ -47,9 +95,22 @@ class UserCreate(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     id: Optional[str] = None
+    exp: Optional[int] = None
+    sid: Optional[str] = None
+
+class CurrentUser(BaseModel):
+    id: int
+    email: Optional[EmailStr] = None
+
+    class Config:
+        orm_mode = True
 
 class Vote(BaseModel):
     post_id: int
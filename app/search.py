@@ -0,0 +1,138 @@
+import heapq
+import math
+import re
+import threading
+from array import array
+from sqlalchemy import select
+from . import models, database
+from .config import settings
+
+# In-process inverted index used when SEARCH_BACKEND=memory (SQLite, tests, single worker
+# deployments). Each uvicorn worker holds its own copy, built at startup and kept current by
+# the post routes, so posts written by another process only show up after a restart.
+
+TOKEN_RE = re.compile(r"\w+")
+TITLE_WEIGHT = 2
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# like MySQL's natural language mode, terms found in more than half of the posts carry no
+# signal and are skipped (they would also mean scoring most of the index on every query)
+COMMON_TERM_RATIO = 0.5
+COMMON_TERM_MIN_POSTS = 1000
+
+
+def tokenize(text: str):
+    return TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    def __init__(self):
+        # term -> (post ids, term frequencies); arrays keep a million posts in a few hundred MB
+        self.postings = {}
+        # post id -> (document length, space separated unique terms) needed to remove it again
+        self.documents = {}
+        self.total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, post_id: int, title: str, content: str):
+        frequencies = {}
+        for term in tokenize(title):
+            frequencies[term] = frequencies.get(term, 0) + TITLE_WEIGHT
+        for term in tokenize(content):
+            frequencies[term] = frequencies.get(term, 0) + 1
+        length = sum(frequencies.values())
+
+        with self._lock:
+            self._remove(post_id)
+            for term, frequency in frequencies.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array("i"), array("H"))
+                ids, tfs = posting
+                ids.append(post_id)
+                tfs.append(min(frequency, 65535))
+            self.documents[post_id] = (length, " ".join(frequencies))
+            self.total_length += length
+
+    def remove(self, post_id: int):
+        with self._lock:
+            self._remove(post_id)
+
+    def _remove(self, post_id: int):
+        document = self.documents.pop(post_id, None)
+        if document is None:
+            return
+        length, terms = document
+        self.total_length -= length
+        for term in terms.split():
+            ids, tfs = self.postings[term]
+            position = ids.index(post_id)
+            del ids[position]
+            del tfs[position]
+            if not ids:
+                del self.postings[term]
+
+    def clear(self):
+        with self._lock:
+            self.postings = {}
+            self.documents = {}
+            self.total_length = 0
+
+    def search(self, query: str, limit: int):
+        # returns up to `limit` (post_id, score) pairs, best match first
+        with self._lock:
+            count = len(self.documents)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            scores = {}
+            for term in set(tokenize(query)):
+                if term not in self.postings:
+                    continue
+                ids, tfs = self.postings[term]
+                if count >= COMMON_TERM_MIN_POSTS and len(ids) > count * COMMON_TERM_RATIO:
+                    continue
+                idf = math.log(1 + (count - len(ids) + 0.5) / (len(ids) + 0.5))
+                documents = self.documents
+                for post_id, tf in zip(ids, tfs):
+                    norm = K1 * (1 - B + B * documents[post_id][0] / average_length)
+                    scores[post_id] = scores.get(post_id, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+
+        # ties go to the newest post, like the unranked listing
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+
+
+search_index = InvertedIndex()
+
+
+def enabled():
+    return settings.search_backend == "memory"
+
+
+def index_post(post):
+    if enabled():
+        search_index.add(post.id, post.title, post.content)
+
+
+def remove_post(post_id: int):
+    if enabled():
+        search_index.remove(post_id)
+
+
+async def rebuild_index(batch_size: int = 10000):
+    search_index.clear()
+    last_id = 0
+    async with database.session_scope() as db:
+        while True:
+            result = await db.execute(select(models.Post.id, models.Post.title, models.Post.content)
+                                      .filter(models.Post.id > last_id).order_by(models.Post.id).limit(batch_size))
+            rows = result.all()
+            if not rows:
+                break
+            for row in rows:
+                search_index.add(row.id, row.title, row.content)
+            last_id = rows[-1].id
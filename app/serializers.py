@@ -0,0 +1,62 @@
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from . import schemas
+from .config import settings
+
+# FAST_JSON turns (Post, votes) rows straight into plain dicts for orjson instead of going through
+# PostOut.from_orm, jsonable_encoder and json.dumps. The dicts follow schemas.PostOut field for
+# field and datetimes use isoformat() like jsonable_encoder, so the bytes are the same either way
+# (tests/test_posts.py compares them); a field added to the schemas has to be added here too.
+
+
+def user_out(user):
+    return {"id": user.id, "email": user.email, "time": user.time.isoformat()}
+
+
+def post(post):
+    return {
+        "title": post.title,
+        "content": post.content,
+        "published": post.published,
+        "id": post.id,
+        "time": post.time.isoformat(),
+        "owner_id": post.owner_id,
+        "version": post.version,
+        "owner": user_out(post.owner),
+    }
+
+
+def post_out(row):
+    if not settings.fast_json:
+        return schemas.PostOut.from_orm(row)
+    return {"Post": post(row.Post), "votes": row.votes, "voted": bool(row.voted)}
+
+
+def sparse_post_out(row, fields: tuple, content_preview: bool = False):
+    # a GET /posts/?fields= row: only the requested columns were loaded, and with content_preview
+    # the content comes truncated from the database as row.content_preview
+    values = {}
+    for field in fields:
+        if field == "content" and content_preview:
+            values["content"] = row.content_preview
+        elif field not in ("votes", "voted"):
+            values[field] = getattr(row.Post, field)
+    if settings.fast_json:
+        if "time" in values:
+            values["time"] = values["time"].isoformat()
+        if "owner" in values:
+            values["owner"] = user_out(values["owner"])
+    out = {"Post": values}
+    if "votes" in fields:
+        out["votes"] = row.votes
+    if "voted" in fields:
+        out["voted"] = bool(row.voted)
+    return out if settings.fast_json else schemas.sparse_post_out(fields).parse_obj(out)
+
+
+def render(content) -> bytes:
+    # the same bytes JSONResponse would send for the response model
+    if settings.fast_json:
+        return orjson.dumps(content, default=jsonable_encoder)
+    return JSONResponse(jsonable_encoder(content)).body
@@ -1,8 +1,57 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from .config import settings
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def hash(password: str):
     return pwd_context.hash(password)
 
 def verify(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return pwd_context.verify(plain_password, hashed_password)
+
+# bcrypt is ~100-300ms of CPU per call, so it runs in its own process pool
+# rather than on the event loop or in the shared threadpool
+hash_executor = None
+hash_jobs_in_flight = 0
+
+def configure_hash_worker(config: dict):
+    pwd_context.load(config)
+
+def get_hash_executor():
+    global hash_executor
+    if hash_executor is None:
+        # created on the first signup or login, when the server already runs threads, so the workers
+        # are spawned rather than forked; they are handed the parent's hash settings instead of
+        # inheriting them
+        hash_executor = ProcessPoolExecutor(max_workers=settings.hash_workers or None, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=configure_hash_worker, initargs=(pwd_context.to_dict(),))
+    return hash_executor
+
+def shutdown_hash_executor():
+    global hash_executor
+    if hash_executor is not None:
+        hash_executor.shutdown(cancel_futures=True)
+        hash_executor = None
+
+async def run_in_hash_executor(func, *args):
+    global hash_jobs_in_flight
+    # shed load once the queue is full instead of letting latency grow without limit
+    if hash_jobs_in_flight >= settings.hash_queue_limit:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is busy, try again later",
+                            headers={"Retry-After": "1"})
+    hash_jobs_in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_hash_executor(), func, *args)
+    finally:
+        hash_jobs_in_flight -= 1
+
+async def hash_async(password: str):
+    return await run_in_hash_executor(hash, password)
+
+async def verify_async(plain_password, hashed_password):
+    return await run_in_hash_executor(verify, plain_password, hashed_password)
@@ -0,0 +1,272 @@
+import asyncio
+import glob
+import logging
+import os
+import threading
+from collections import Counter
+from sqlalchemy import bindparam, delete, insert, select, tuple_, update
+from starlette.concurrency import run_in_threadpool
+from . import database, models, response_cache, vote_stream
+from .config import settings
+
+# Write-behind voting (VOTE_BUFFER=true). POST /vote/ records the intent and answers 202; intents are
+# keyed by (post_id, user_id) so toggles collapse to the last one, and are applied in one
+# transaction per batch when VOTE_BUFFER_MAX_SIZE intents are waiting or every
+# VOTE_BUFFER_FLUSH_SECONDS. With VOTE_BUFFER_LOG_PATH set, an intent is appended (and fsync'd)
+# to a local log before it is acknowledged and replayed on startup, so a crash doesn't lose it.
+
+logger = logging.getLogger("app.vote_buffer")
+# every statement binds fewer than SQLite's pre-3.32 limit of 999 parameters, as the bulk post
+# insert does: ids one parameter each, (post_id, user_id) pairs two
+MAX_PARAMS = 999
+BATCH_CHUNK = 500
+PAIR_CHUNK = MAX_PARAMS // 2
+
+
+class VoteLog:
+    # numbered segments <path>.<n>: a flush seals the current segment, and deletes it (and older
+    # ones) once its batch has committed
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self.file = None
+        self.segment = max(self.segments(), default=0) + 1
+        self.written = 0
+        self.synced = 0
+
+    def segments(self):
+        numbers = []
+        for name in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = name.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def write(self, post_id: int, user_id: int, direction: int):
+        # caller holds self.lock
+        if self.file is None:
+            self.file = open(f"{self.path}.{self.segment}", "ab")
+        self.file.write(f"{post_id} {user_id} {direction}\n".encode())
+        self.written += 1
+        return self.written
+
+    def sync(self, sequence: int):
+        # group commit: one fsync covers every record written before it started, so concurrent
+        # callers mostly find their record already synced and return without an fsync of their own
+        with self._sync_lock:
+            if self.synced >= sequence:
+                return
+            # records up to `written` are all in the file's buffer; seal() takes _sync_lock before
+            # closing the file, so it stays open here
+            target = self.written
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.synced = target
+
+    def seal(self):
+        # caller holds self.lock; returns the last segment that belongs to the batch being taken
+        with self._sync_lock:
+            if self.file is not None:
+                self.file.flush()
+                if self.fsync:
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+            self.synced = self.written
+            sealed = self.segment
+            self.segment += 1
+            return sealed
+
+    def drop_through(self, segment: int):
+        for number in self.segments():
+            if number <= segment:
+                os.remove(f"{self.path}.{number}")
+
+    def replay(self):
+        intents = {}
+        for number in self.segments():
+            with open(f"{self.path}.{number}", "rb") as file:
+                for line in file:
+                    parts = line.split()
+                    # a torn last line from a crash mid-write was never acknowledged
+                    if len(parts) == 3 and all(part.isdigit() for part in parts):
+                        post_id, user_id, direction = map(int, parts)
+                        intents[(post_id, user_id)] = direction
+        return intents
+
+    def close(self):
+        with self.lock, self._sync_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def apply_votes(session, intents: dict, counts: dict = None):
+    # Sets each (post_id, user_id) to its final intent, so applying a batch twice is harmless.
+    # The UPDATE touches nothing but locks the posts rows first (and takes SQLite's write lock), in
+    # the same order direct votes use, so the diff below can't race another flush or vote.
+    post_ids = sorted({post_id for post_id, user_id in intents})
+    existing_posts = set()
+    for start in range(0, len(post_ids), BATCH_CHUNK):
+        chunk = post_ids[start:start + BATCH_CHUNK]
+        session.execute(update(models.Post).where(models.Post.id.in_(chunk)).values(votes_count=models.Post.votes_count))
+        existing_posts.update(session.scalars(select(models.Post.id).where(models.Post.id.in_(chunk))))
+
+    # votes on posts deleted (or never created) in the meantime are dropped
+    pairs = [pair for pair in intents if pair[0] in existing_posts]
+    existing_votes = set()
+    for start in range(0, len(pairs), PAIR_CHUNK):
+        chunk = pairs[start:start + PAIR_CHUNK]
+        existing_votes.update(session.execute(select(models.Vote.post_id, models.Vote.user_id)
+                                              .where(tuple_(models.Vote.post_id, models.Vote.user_id).in_(chunk))).tuples())
+
+    to_insert = [pair for pair in pairs if intents[pair] == 1 and pair not in existing_votes]
+    to_delete = [pair for pair in pairs if intents[pair] != 1 and pair in existing_votes]
+    votes = models.Vote.__table__
+    posts = models.Post.__table__
+    if to_insert:
+        session.execute(insert(votes), [{"post_id": post_id, "user_id": user_id} for post_id, user_id in to_insert])
+    if to_delete:
+        session.execute(delete(votes).where(votes.c.post_id == bindparam("b_post_id"), votes.c.user_id == bindparam("b_user_id")),
+                        [{"b_post_id": post_id, "b_user_id": user_id} for post_id, user_id in to_delete])
+
+    deltas = Counter()
+    for post_id, user_id in to_insert:
+        deltas[post_id] += 1
+    for post_id, user_id in to_delete:
+        deltas[post_id] -= 1
+    changed = [{"b_id": post_id, "b_delta": delta} for post_id, delta in deltas.items() if delta]
+    if changed:
+        session.execute(update(posts).where(posts.c.id == bindparam("b_id")).values(votes_count=posts.c.votes_count + bindparam("b_delta"), votes_seq=posts.c.votes_seq + 1), changed)
+    if counts is not None:
+        # the new (votes_count, votes_seq) of the posts that changed, for the vote streams
+        changed_ids = sorted(post_id for post_id, delta in deltas.items() if delta)
+        for start in range(0, len(changed_ids), BATCH_CHUNK):
+            chunk = changed_ids[start:start + BATCH_CHUNK]
+            counts.update((post_id, (votes, seq)) for post_id, votes, seq in session.execute(
+                select(models.Post.id, models.Post.votes_count, models.Post.votes_seq).where(models.Post.id.in_(chunk))))
+    session.commit()
+    return {"inserted": len(to_insert), "deleted": len(to_delete), "dropped": len(intents) - len(pairs)}
+
+
+class VoteBuffer:
+    def __init__(self, max_size: int, flush_seconds: float, log_path: str = "", fsync: bool = True):
+        self.max_size = max_size
+        self.flush_seconds = flush_seconds
+        self.log = VoteLog(log_path, fsync) if log_path else None
+        self.pending = {}
+        self._lock = self.log.lock if self.log else threading.Lock()
+        self._flushing = threading.Lock()
+        self._task = None
+        self._stopping = None
+        self.flushes = 0
+        self.applied = Counter()
+
+    def _record(self, post_id: int, user_id: int, direction: int):
+        with self._lock:
+            self.pending[(post_id, user_id)] = direction
+            return self.log.write(post_id, user_id, direction) if self.log else None
+
+    async def add(self, post_id: int, user_id: int, direction: int):
+        if self.log is None:
+            self._record(post_id, user_id, direction)
+            return
+        # acknowledged only once the intent is on disk
+        await run_in_threadpool(self._sync_record, post_id, user_id, direction)
+
+    def _sync_record(self, post_id: int, user_id: int, direction: int):
+        self.log.sync(self._record(post_id, user_id, direction))
+
+    def full(self):
+        return len(self.pending) >= self.max_size
+
+    def _take(self):
+        with self._lock:
+            batch, self.pending = self.pending, {}
+            sealed = self.log.seal() if self.log else None
+        return batch, sealed
+
+    async def flush(self, db, wait: bool = False):
+        # one flush at a time; a caller that finds one running leaves its intents for the next,
+        # unless it waits for it to finish
+        while not self._flushing.acquire(blocking=False):
+            if not wait:
+                return None
+            await asyncio.sleep(0.01)
+        try:
+            if self.log:
+                batch, sealed = await run_in_threadpool(self._take)
+            else:
+                batch, sealed = self._take()
+            if not batch:
+                return None
+            counts = {} if vote_stream.broker is not None else None
+            try:
+                result = await db.run_sync(apply_votes, batch, counts)
+            except BaseException:
+                # put the batch back under anything recorded since (also when the flush is
+                # cancelled, which can happen in async mode); its log segments stay on disk
+                with self._lock:
+                    for pair, direction in batch.items():
+                        self.pending.setdefault(pair, direction)
+                raise
+            if self.log:
+                await run_in_threadpool(self.log.drop_through, sealed)
+            self.flushes += 1
+            self.applied.update(result)
+            await response_cache.invalidate(*{f"post:{post_id}" for post_id, user_id in batch})
+            for post_id, (votes, seq) in (counts or {}).items():
+                await vote_stream.broker.publish(post_id, votes, seq)
+            return result
+        finally:
+            self._flushing.release()
+
+    async def flush_now(self, wait: bool = False):
+        async with database.session_scope() as db:
+            return await self.flush(db, wait)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_seconds)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush_now()
+            except Exception:
+                logger.exception("vote buffer flush failed, retrying in %ss", self.flush_seconds)
+
+    async def start(self):
+        if self.log:
+            replayed = await run_in_threadpool(self.log.replay)
+            with self._lock:
+                for pair, direction in replayed.items():
+                    self.pending.setdefault(pair, direction)
+            if replayed:
+                logger.info("replaying %d buffered votes from %s", len(replayed), self.log.path)
+                await self.flush_now()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # a flush in progress finishes instead of being cancelled halfway
+            self._stopping.set()
+            await self._task
+            self._task = None
+        # then everything still queued, waiting out a flush a request may be running
+        while self.pending:
+            await self.flush_now(wait=True)
+        if self.log:
+            self.log.close()
+
+    def stats(self):
+        return {"pending": len(self.pending), "flushes": self.flushes, **self.applied}
+
+
+buffer = VoteBuffer(max_size=settings.vote_buffer_max_size, flush_seconds=settings.vote_buffer_flush_seconds,
+                    log_path=settings.vote_buffer_log_path, fsync=settings.vote_buffer_fsync) if settings.vote_buffer else None
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from .config import settings
+
+# Live vote counts for GET /posts/{id}/votes/stream and its WebSocket variant. A vote publishes its
+# post's new count once committed; the broker hands it to every stream following that post. With
+# the redis backend the counts go through a Redis channel, so a vote taken by one worker reaches
+# the streams held by every other worker.
+
+logger = logging.getLogger("app.vote_stream")
+
+
+class Subscription:
+    # one connection following one post. Only the latest count is kept, so a connection costs the
+    # same memory however fast votes arrive or however slowly the client reads
+    def __init__(self, post_id: int):
+        self.post_id = post_id
+        self.votes = None
+        # the posts.votes_seq self.votes was read at; counts are published in whatever order their
+        # requests finish, so one older than this is dropped
+        self.seq = -1
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def offer(self, votes: int, seq: int):
+        # may be called from any thread
+        with self._lock:
+            if seq <= self.seq:
+                return
+            self.votes, self.seq = votes, seq
+        try:
+            self._loop.call_soon_threadsafe(self._changed.set)
+        except RuntimeError:
+            # the connection's event loop has already gone
+            pass
+
+    async def next(self, timeout: float, coalesce_seconds: float):
+        # the latest count once it changes, or None if it didn't within timeout
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        # a burst of votes within the window goes out as one update
+        if coalesce_seconds > 0:
+            await asyncio.sleep(coalesce_seconds)
+        return self.take()
+
+    def take(self):
+        self._changed.clear()
+        return self.votes
+
+
+class LocalBroker:
+    # streams in this process only
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.subscriptions = {}
+        self.connections = 0
+        self.published = 0
+        self.delivered = 0
+        self._lock = threading.Lock()
+
+    def full(self):
+        return self.connections >= self.max_connections
+
+    def subscribe(self, post_id: int):
+        subscription = Subscription(post_id)
+        with self._lock:
+            self.subscriptions.setdefault(post_id, set()).add(subscription)
+            self.connections += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        # safe to call more than once
+        with self._lock:
+            followers = self.subscriptions.get(subscription.post_id)
+            if followers is None or subscription not in followers:
+                return
+            followers.discard(subscription)
+            if not followers:
+                del self.subscriptions[subscription.post_id]
+            self.connections -= 1
+
+    def wants(self, post_id: int):
+        # whether a count published for the post would reach anyone
+        return post_id in self.subscriptions
+
+    async def publish(self, post_id: int, votes: int, seq: int):
+        self.published += 1
+        self.deliver(post_id, votes, seq)
+
+    def deliver(self, post_id: int, votes: int, seq: int):
+        with self._lock:
+            followers = tuple(self.subscriptions.get(post_id, ()))
+        for subscription in followers:
+            subscription.offer(votes, seq)
+        self.delivered += len(followers)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self):
+        return {"backend": "memory", "connections": self.connections, "posts": len(self.subscriptions),
+                "published": self.published, "delivered": self.delivered}
+
+
+class RedisBroker(LocalBroker):
+    # shared by every worker; needs `pip install redis`
+    def __init__(self, url: str, max_connections: int, channel: str = "vote-counts"):
+        super().__init__(max_connections)
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.channel = channel
+        self._task = None
+
+    def wants(self, post_id: int):
+        # streams on other workers can't be seen from here
+        return True
+
+    async def publish(self, post_id: int, votes: int, seq: int):
+        # the vote has committed by now; a lost update is corrected by the next one
+        try:
+            await self.client.publish(self.channel, json.dumps({"post_id": post_id, "votes": votes, "seq": seq}))
+            self.published += 1
+        except Exception:
+            logger.exception("publishing the count of post %s failed", post_id)
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            update = json.loads(message["data"])
+                            self.deliver(int(update["post_id"]), int(update["votes"]), int(update["seq"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("vote count subscription failed, resubscribing in 1s")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {**super().stats(), "backend": "redis"}
+
+
+async def updates(subscription: Subscription):
+    # the current count, then each change (at most one per VOTE_STREAM_COALESCE_SECONDS), and None
+    # when nothing changed for VOTE_STREAM_KEEPALIVE_SECONDS; ends after VOTE_STREAM_MAX_SECONDS,
+    # so a stream can't outlive the token it was opened with by long
+    deadline = time.monotonic() + settings.vote_stream_max_seconds
+    yield subscription.take()
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield await subscription.next(min(settings.vote_stream_keepalive_seconds, remaining), settings.vote_stream_coalesce_seconds)
+
+
+def make_broker(name: str):
+    if name == "memory":
+        return LocalBroker(max_connections=settings.vote_stream_max_connections)
+    if name == "redis":
+        return RedisBroker(settings.redis_url, max_connections=settings.vote_stream_max_connections)
+    return None
+
+
+broker = make_broker(settings.vote_stream_backend)
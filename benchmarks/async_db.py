@@ -0,0 +1,164 @@
+# Concurrent-request throughput of GET /posts/ with the database called three ways:
+#   blocking - sync Session called straight from the async route (how the routers used to work)
+#   threaded - sync Session behind database.ThreadedSession (database_async = False)
+#   async    - AsyncSession on aiosqlite (database_async = True)
+#
+# A sqlite file stands in for MySQL; --latency-ms adds a sleep per statement inside
+# the driver thread to mimic a network round trip.
+#
+#   python -m benchmarks.async_db --requests 2000 --concurrency 50 --latency-ms 5
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.main import app
+from app.database import get_db, Base, ThreadedSession
+from app.oauth2 import create_access_token
+from app import models
+
+
+class InlineSession(ThreadedSession):
+    # the pre-async behaviour: blocking calls made directly on the event loop
+    async def execute(self, statement, *args, **kwargs):
+        return self.sync_session.execute(statement, *args, **kwargs)
+
+    async def commit(self):
+        self.sync_session.commit()
+
+    async def refresh(self, instance, attribute_names=None):
+        self.sync_session.refresh(instance, attribute_names)
+
+    async def close(self):
+        self.sync_session.close()
+
+
+def seed(path, users, posts):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all([models.User(email=f"user{i}@example.com", password="x") for i in range(users)])
+        db.flush()
+        db.add_all([models.Post(title=f"title {i}", content="content", owner_id=i % users + 1) for i in range(posts)])
+        db.commit()
+    engine.dispose()
+
+
+def add_latency(dbapi_connection, latency):
+    dbapi_connection.set_trace_callback(lambda statement: time.sleep(latency))
+
+
+def use_sync_database(path, latency, session_class):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, pool_size=50)
+    if latency:
+        event.listen(engine, "connect", lambda dbapi_connection, record: add_latency(dbapi_connection, latency))
+    SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+    async def override_get_db():
+        db = session_class(SessionLocal())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+
+    async def dispose():
+        engine.dispose()
+
+    return dispose
+
+
+def use_async_database(path, latency):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"check_same_thread": False},
+                                 poolclass=AsyncAdaptedQueuePool, pool_size=50)
+    if latency:
+        # the sqlite3 connection lives in aiosqlite's worker thread, so the sleep does too
+        event.listen(engine.sync_engine, "connect",
+                     lambda dbapi_connection, record: add_latency(dbapi_connection.driver_connection._conn, latency))
+    AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    return engine.dispose
+
+
+async def drive(requests, concurrency, headers):
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait("/posts/?limit=10")
+
+    async def worker(client):
+        while not queue.empty():
+            url = queue.get_nowait()
+            start = time.perf_counter()
+            res = await client.get(url, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            assert res.status_code == 200, res.text
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+async def run_mode(dispose, requests, concurrency, headers):
+    try:
+        return await drive(requests, concurrency, headers)
+    finally:
+        app.dependency_overrides.clear()
+        await dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--modes", default="blocking,threaded,async")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    seed(path, args.users, args.posts)
+    headers = {"Authorization": f"Bearer {create_access_token({'user_id': 1})}"}
+    latency = args.latency_ms / 1000
+
+    results = {}
+    for mode in args.modes.split(","):
+        if mode == "blocking":
+            dispose = use_sync_database(path, latency, InlineSession)
+        elif mode == "threaded":
+            dispose = use_sync_database(path, latency, ThreadedSession)
+        else:
+            dispose = use_async_database(path, latency)
+        results[mode] = asyncio.run(run_mode(dispose, args.requests, args.concurrency, headers))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
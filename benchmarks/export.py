@@ -0,0 +1,89 @@
+# Resident memory of the server while GET /posts/export streams every post, against a real uvicorn
+# server (the test client would buffer the whole body). RSS is sampled from /proc while the export runs.
+#
+#   python -m benchmarks.export --posts 1000000 --format ndjson
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+import httpx
+
+from app.oauth2 import create_access_token
+from benchmarks.load import seed, use_database, start_server, free_port
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.samples.append(rss_mb())
+            time.sleep(self.interval)
+
+
+async def export(base_url, format, headers):
+    rows = size = 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        async with client.stream("GET", "/posts/export", params={"format": format}, headers=headers) as res:
+            assert res.status_code == 200, await res.aread()
+            async for chunk in res.aiter_bytes():
+                rows += chunk.count(b"\n")
+                size += len(chunk)
+    return rows - (format == "csv"), size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--format", default="ndjson", choices=["ndjson", "csv"])
+    parser.add_argument("--database-url", help="database to seed and serve from (default: a new SQLite file)")
+    args = parser.parse_args()
+
+    url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'export.db')}"
+    seed(url, args.users, args.posts, 0, 1)
+    use_database(url)
+    port = free_port()
+    server, thread = start_server(port)
+    headers = {"Authorization": f"Bearer {create_access_token({'user_id': 1})}"}
+
+    before = rss_mb()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        rows, size = asyncio.run(export(f"http://127.0.0.1:{port}", args.format, headers))
+    finally:
+        sampler.done.set()
+        sampler.join()
+        server.should_exit = True
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # the client's memory is in this process too, but it keeps nothing beyond the current chunk
+    print(json.dumps({
+        "rows": rows,
+        "megabytes_streamed": round(size / 2**20, 1),
+        "seconds": round(elapsed, 1),
+        "rows_per_second": round(rows / elapsed),
+        "rss_before_mb": round(before, 1),
+        "rss_peak_mb": round(max(sampler.samples), 1),
+        "rss_growth_mb": round(max(sampler.samples) - before, 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
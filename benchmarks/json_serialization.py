@@ -0,0 +1,80 @@
+# CPU cost of turning a page of (Post, votes) rows into the GET /posts/ response body:
+#   response_model - FastAPI's response_model handling: validate List[PostOut] from the rows, jsonable_encoder, json.dumps
+#   schema         - PostOut.from_orm per row, jsonable_encoder, json.dumps (the default path)
+#   fast_json      - plain dicts and orjson (FAST_JSON=true)
+# No database is involved; the rows are built in memory.
+#
+#   python -m benchmarks.json_serialization --limits 10,100,1000
+import argparse
+import asyncio
+import json
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app import models, schemas, serializers
+from app.config import settings
+
+Row = namedtuple("Row", "Post votes voted")
+loop = asyncio.new_event_loop()
+
+
+def make_rows(count):
+    owner = models.User(id=1, email="user@example.com", password="x", time=datetime(2026, 1, 1, tzinfo=timezone.utc))
+    return [Row(models.Post(id=i, title=f"title {i}", content="content " * 20, published=True, owner_id=1, version=1, owner=owner,
+                            time=datetime(2026, 1, 1, 12, 0, i % 60, 123456, tzinfo=timezone.utc)), i % 7, i % 2 == 0)
+            for i in range(count)]
+
+
+def response_model_path(rows, field):
+    return JSONResponse(loop.run_until_complete(serialize_response(field=field, response_content=rows))).body
+
+
+def schema_path(rows):
+    settings.fast_json = False
+    return serializers.render([serializers.post_out(row) for row in rows])
+
+
+def fast_json_path(rows):
+    settings.fast_json = True
+    return serializers.render([serializers.post_out(row) for row in rows])
+
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return round((time.perf_counter() - start) / iterations * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limits", default="10,100,1000")
+    parser.add_argument("--rows-per-run", type=int, default=200000, help="iterations are scaled so each run serializes about this many rows")
+    args = parser.parse_args()
+
+    field = create_response_field(name="response", type_=List[schemas.PostOut])
+    results = {}
+    for limit in map(int, args.limits.split(",")):
+        rows = make_rows(limit)
+        iterations = max(args.rows_per_run // limit, 5)
+        bodies = {"response_model": response_model_path(rows, field), "schema": schema_path(rows), "fast_json": fast_json_path(rows)}
+        assert len(set(bodies.values())) == 1, "serializers disagree"
+        timings = {
+            "response_model_ms": measure(lambda: response_model_path(rows, field), iterations),
+            "schema_ms": measure(lambda: schema_path(rows), iterations),
+            "fast_json_ms": measure(lambda: fast_json_path(rows), iterations),
+        }
+        timings["speedup_vs_schema"] = round(timings["schema_ms"] / timings["fast_json_ms"], 1)
+        results[f"limit={limit}"] = timings
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Cost per request of oauth2.verfiy_access_token with the decoded-token cache on and off,
+# for every JWT backend that is installed.
+#
+#   python -m benchmarks.jwt_verify --iterations 100000 --tokens 1000
+import argparse
+import json
+import random
+import time
+
+from fastapi import HTTPException
+from app import oauth2
+from app.cache import TTLCache
+
+
+def measure(tokens, iterations):
+    credentials_exception = HTTPException(status_code=401)
+    sample = [random.choice(tokens) for _ in range(iterations)]
+    start = time.perf_counter()
+    for token in sample:
+        oauth2.verfiy_access_token(token, credentials_exception)
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50000)
+    parser.add_argument("--tokens", type=int, default=1000, help="distinct bearer tokens in the request mix")
+    args = parser.parse_args()
+
+    results = {}
+    for name, backend_class in oauth2.JWT_BACKENDS.items():
+        try:
+            oauth2.jwt_backend = backend_class()
+        except ImportError:
+            continue
+        tokens = [oauth2.create_access_token({"user_id": i}) for i in range(args.tokens)]
+        oauth2.token_cache = TTLCache(maxsize=0, ttl=0)
+        uncached = measure(tokens, args.iterations)
+        oauth2.token_cache = TTLCache(maxsize=args.tokens, ttl=oauth2.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+        cached = measure(tokens, args.iterations)
+        results[name] = {
+            "uncached_us_per_request": round(uncached, 2),
+            "cached_us_per_request": round(cached, 2),
+            "speedup": round(uncached / cached, 1),
+            "cache": oauth2.token_cache.stats(),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Mixed-workload HTTP load test: seeds a database, boots app.main:app under uvicorn and drives
+# login / list / detail / search / vote / create requests at it from concurrent clients, then
+# prints per-route RPS and p50/p95/p99 latency as JSON.
+#
+# The database is a fresh SQLite file unless --database-url points somewhere else, e.g. a
+# disposable local MySQL schema (its tables are dropped and recreated). Settings such as
+# DATABASE_ASYNC, SEARCH_BACKEND or RESPONSE_CACHE_BACKEND are read from the environment as usual.
+#
+#   python -m benchmarks.load --users 100 --posts 10000 --votes 50000 --duration 30 --concurrency 50
+#   python -m benchmarks.load --output after.json --baseline before.json --max-regression 0.2
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+from sqlalchemy import create_engine, insert, update, select, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from app.main import app
+from app.config import settings
+from app.oauth2 import create_access_token
+from app import database, models, utils
+
+PASSWORD = "password123"
+WORDS = ("python", "fastapi", "mysql", "cache", "index", "async", "docker", "query", "token", "vote",
+         "latency", "replica", "cursor", "search", "deploy", "schema", "worker", "pool", "redis", "json")
+DEFAULT_MIX = "list=35,detail=30,search=10,vote=15,create=5,login=5"
+
+
+def seed(url, users, posts, votes, seed_value):
+    rng = random.Random(seed_value)
+    engine = create_engine(url)
+    if engine.dialect.name == "sqlite":
+        # WAL lets readers run while a write commits; the default journal makes them fail with "database is locked"
+        with engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    database.Base.metadata.drop_all(engine)
+    database.Base.metadata.create_all(engine)
+    # one bcrypt hash shared by every user; hashing per user would dominate the seeding time
+    password = utils.hash(PASSWORD)
+    votes = min(votes, users * posts)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"email": f"user{i}@example.com", "password": password} for i in range(users)])
+        for start in range(0, posts, 10000):
+            conn.execute(insert(models.Post), [{"title": " ".join(rng.choices(WORDS, k=4)), "content": " ".join(rng.choices(WORDS, k=20)),
+                                                "owner_id": rng.randint(1, users)} for _ in range(start, min(start + 10000, posts))])
+        pairs = set()
+        while len(pairs) < votes:
+            pairs.add((rng.randint(1, posts), rng.randint(1, users)))
+        pairs = sorted(pairs)
+        for start in range(0, len(pairs), 10000):
+            conn.execute(insert(models.Vote), [{"post_id": post_id, "user_id": user_id} for post_id, user_id in pairs[start:start + 10000]])
+        counts = (select(func.count(models.Vote.post_id)).where(models.Vote.post_id == models.Post.id).scalar_subquery())
+        conn.execute(update(models.Post).values(votes_count=counts))
+    engine.dispose()
+
+
+def use_database(url):
+    # repoint app.database at the benchmark database; get_db, search.rebuild_index and /metrics/ follow
+    if settings.database_async:
+        database.async_engine = database.make_engine(url, asynchronous=True)
+        database.AsyncSessionLocal = async_sessionmaker(database.async_engine, autoflush=False, expire_on_commit=False)
+    else:
+        database.engine = database.make_engine(url)
+        database.SessionLocal = sessionmaker(autoflush=False, bind=database.engine)
+
+
+def start_server(port):
+    # the load generator shares this process's CPU, so a worker can sit idle past uvicorn's default
+    # 5s keep-alive under heavy load; the server would then drop a connection the client is reusing
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=75))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            sys.exit("server failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        sys.exit(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+# each operation returns (route, method, url, request options); the route is what results are grouped by
+def op_list(rng, args):
+    return "GET /posts/", "GET", "/posts/", {"params": {"limit": 10, "skip": rng.choice((0, 0, 0, 10, 20, 50))}}
+
+def op_detail(rng, args):
+    return "GET /posts/{id}", "GET", f"/posts/{rng.randint(1, args.posts)}", {}
+
+def op_search(rng, args):
+    return "GET /posts/?search", "GET", "/posts/", {"params": {"search": rng.choice(WORDS), "limit": 10}}
+
+def op_vote(rng, args):
+    return "POST /vote/", "POST", "/vote/", {"json": {"post_id": rng.randint(1, args.posts), "dir": rng.choice((0, 1))}}
+
+def op_create(rng, args):
+    return "POST /posts/", "POST", "/posts/", {"json": {"title": " ".join(rng.choices(WORDS, k=4)), "content": " ".join(rng.choices(WORDS, k=20))}}
+
+def op_login(rng, args):
+    return "POST /login", "POST", "/login", {"data": {"username": f"user{rng.randrange(args.users)}@example.com", "password": PASSWORD}}
+
+OPERATIONS = {"list": op_list, "detail": op_detail, "search": op_search, "vote": op_vote, "create": op_create, "login": op_login}
+# a vote on a missing post or a repeated vote is a normal outcome, not an error
+EXPECTED_STATUSES = {"POST /vote/": (201, 404, 409)}
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return None
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return round(sorted_values[index] * 1000, 2)
+
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+        "errors": errors,
+        "statuses": dict(sorted(statuses.items())),
+    }
+
+
+async def drive(base_url, args, weights):
+    names, name_weights = list(weights), list(weights.values())
+    tokens = [{"Authorization": f"Bearer {create_access_token({'user_id': user_id})}"}
+              for user_id in range(1, min(args.users, 1000) + 1)]
+    samples = {}
+
+    async def worker(client, worker_id, deadline, record):
+        rng = random.Random(args.seed * 1000 + worker_id)
+        while time.perf_counter() < deadline:
+            route, method, url, options = OPERATIONS[rng.choices(names, weights=name_weights)[0]](rng, args)
+            start = time.perf_counter()
+            try:
+                res = await client.request(method, url, headers=rng.choice(tokens), **options)
+                status = res.status_code
+            except httpx.HTTPError as error:
+                # a dropped connection or timeout, e.g. after an unhandled exception in the app
+                status = type(error).__name__
+            if record:
+                latencies, statuses, errors = samples.setdefault(route, ([], {}, [0]))
+                latencies.append(time.perf_counter() - start)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status not in EXPECTED_STATUSES.get(route, (200, 201)):
+                    errors[0] += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        if args.warmup:
+            deadline = time.perf_counter() + args.warmup
+            await asyncio.gather(*(worker(client, i, deadline, False) for i in range(args.concurrency)))
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(worker(client, i, deadline, True) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    routes = {route: summarize(latencies, statuses, errors[0], elapsed) for route, (latencies, statuses, errors) in sorted(samples.items())}
+    every_latency = [latency for latencies, _, _ in samples.values() for latency in latencies]
+    total_statuses = {}
+    for _, statuses, _ in samples.values():
+        for code, count in statuses.items():
+            total_statuses[code] = total_statuses.get(code, 0) + count
+    total = summarize(every_latency, total_statuses, sum(errors[0] for _, _, errors in samples.values()), elapsed)
+    return total, routes
+
+
+def compare(results, baseline, max_regression):
+    # a route regresses when its p95 grows or its throughput drops by more than max_regression
+    regressions = []
+    for route, current in {"total": results["total"], **results["routes"]}.items():
+        before = baseline["total"] if route == "total" else baseline.get("routes", {}).get(route)
+        if not before or not before.get("requests") or not current["requests"]:
+            continue
+        if before["p95_ms"] and current["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{route}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms")
+        if before["rps"] and current["rps"] < before["rps"] * (1 - max_regression):
+            regressions.append(f"{route}: rps {before['rps']} -> {current['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", help="database to seed and serve from (default: a new SQLite file)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--votes", type=int, default=50000)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight pairs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"
+    seed(url, args.users, args.posts, args.votes, args.seed)
+    use_database(url)
+
+    # fork the bcrypt worker processes before the server and its threads exist
+    utils.get_hash_executor().submit(int).result()
+    port = free_port()
+    server, thread = start_server(port)
+    try:
+        total, routes = asyncio.run(drive(f"http://127.0.0.1:{port}", args, weights))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    results = {
+        "config": {
+            "users": args.users, "posts": args.posts, "votes": args.votes, "duration": args.duration,
+            "concurrency": args.concurrency, "mix": weights, "database": make_url(url).get_backend_name(),
+            "database_async": settings.database_async, "search_backend": settings.search_backend,
+            "response_cache_backend": settings.response_cache_backend,
+        },
+        "total": total,
+        "routes": routes,
+    }
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
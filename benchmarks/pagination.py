@@ -0,0 +1,89 @@
+# GET /posts/ latency at page 1 vs a deep page, paging with skip (OFFSET) and with cursor (keyset).
+#
+#   python -m benchmarks.pagination --posts 200000 --page 10000 --limit 10
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app.main import app
+from app.database import get_db, Base, ThreadedSession
+from app.oauth2 import create_access_token
+from app.routers.post import encode_cursor
+from app import models
+
+
+def seed(engine, users, posts, votes_per_post):
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"email": f"user{i}@example.com", "password": "x"} for i in range(users)])
+        conn.execute(insert(models.Post), [{"title": f"title {i}", "content": "content", "owner_id": i % users + 1}
+                                           for i in range(posts)])
+        conn.execute(insert(models.Vote), [{"post_id": post_id, "user_id": user_id}
+                                           for post_id in range(1, posts + 1)
+                                           for user_id in range(1, min(votes_per_post, users) + 1)])
+
+
+async def time_url(client, url, samples, headers):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        res = await client.get(url, headers=headers)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert res.status_code == 200, res.text
+    return round(statistics.median(latencies), 2)
+
+
+async def run(args, headers):
+    deep_skip = (args.page - 1) * args.limit
+    # ids run 1..posts and cursor pages from an empty ?cursor= are newest first, so the cursor for a
+    # page is the id just above it
+    deep_cursor = encode_cursor({"id": args.posts - deep_skip + 1})
+    urls = {
+        "skip_page_1_ms": f"/posts/?limit={args.limit}",
+        f"skip_page_{args.page}_ms": f"/posts/?limit={args.limit}&skip={deep_skip}",
+        "cursor_page_1_ms": f"/posts/?limit={args.limit}&cursor=",
+        f"cursor_page_{args.page}_ms": f"/posts/?limit={args.limit}&cursor={deep_cursor}",
+    }
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        return {name: await time_url(client, url, args.samples, headers) for name, url in urls.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--votes-per-post", type=int, default=2)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--page", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=20)
+    args = parser.parse_args()
+    assert args.page * args.limit <= args.posts, "not enough posts for that page"
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    seed(engine, args.users, args.posts, args.votes_per_post)
+    SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+    async def override_get_db():
+        db = ThreadedSession(SessionLocal())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    headers = {"Authorization": f"Bearer {create_access_token({'user_id': 1})}"}
+    results = asyncio.run(run(args, headers))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Getting a fresh access token two ways: POST /login (bcrypt verify in the hash process pool) and
+# POST /token/refresh (sha256 lookup and rotation of the refresh token). Each client logs in once and
+# then keeps refreshing its own token chain, against a seeded SQLite database.
+#
+#   python -m benchmarks.refresh_tokens --users 50 --requests 500 --concurrency 10
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import httpx
+
+from app import utils
+from app.main import app
+from app.oauth2 import principal_cache
+from benchmarks.load import PASSWORD, percentile, seed, use_database
+
+
+async def measure(requests, concurrency, call):
+    latencies = []
+    statuses = {}
+    remaining = iter(range(requests))
+
+    async def worker(client, index):
+        for _ in remaining:
+            started = time.perf_counter()
+            status = await call(client, index)
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(app=app, base_url="http://benchmark", timeout=120) as client:
+        await asyncio.gather(*(worker(client, index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"per_s": round(requests / elapsed, 1), "p50_ms": percentile(latencies, 0.5), "p95_ms": percentile(latencies, 0.95),
+            "statuses": statuses}
+
+
+async def run(args):
+    tokens = {}
+
+    async def login(client, index):
+        res = await client.post("/login", data={"username": f"user{index % args.users}@example.com", "password": PASSWORD})
+        if res.status_code == 200:
+            tokens[index] = res.json()["refresh_token"]
+        return res.status_code
+
+    async def refresh(client, index):
+        if index not in tokens:
+            return None
+        res = await client.post("/token/refresh", json={"refresh_token": tokens[index]})
+        if res.status_code == 200:
+            tokens[index] = res.json()["refresh_token"]
+        return res.status_code
+
+    return {"login": await measure(args.requests, args.concurrency, login),
+            "refresh": await measure(args.requests, args.concurrency, refresh)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    # a login holds its database connection while bcrypt runs, so stay within DB_POOL_SIZE + DB_MAX_OVERFLOW
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'refresh.db')}"
+        seed(url, args.users, 0, 0, args.seed)
+        use_database(url)
+        principal_cache.clear()
+        # fork the bcrypt worker processes before anything else starts threads
+        utils.get_hash_executor().submit(int).result()
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            utils.shutdown_hash_executor()
+    results["speedup"] = round(results["refresh"]["per_s"] / results["login"]["per_s"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Search over synthetic posts: the in-process inverted index (SEARCH_BACKEND=memory) against the
+# LIKE '%term%' scan used by SEARCH_BACKEND=like, on the same SQLite data.
+#
+#   python -m benchmarks.search --posts 1000000 --queries 200
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+
+from app.database import Base
+from app.search import InvertedIndex
+from app import models
+
+
+def synthetic_posts(count, vocabulary, seed=42):
+    rng = random.Random(seed)
+    # skewed word choice so a few terms are very common, like real text
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    for post_id in range(1, count + 1):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=16)
+        yield post_id, " ".join(words[:4]), " ".join(words[4:])
+
+
+def median_ms(func, queries):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        func(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--skip-like", action="store_true", help="only benchmark the inverted index")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    vocabulary = [f"w{i}" for i in range(args.vocabulary)]
+    queries = [rng.choice(vocabulary) for _ in range(args.queries)]
+    results = {"posts": args.posts}
+
+    index = InvertedIndex()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for post_id, title, content in synthetic_posts(args.posts, vocabulary):
+        index.add(post_id, title, content)
+    results["index_build_s"] = round(time.perf_counter() - start, 1)
+    results["index_peak_rss_growth_mb"] = round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1)
+    results["index_query_p50_ms"] = median_ms(lambda query: index.search(query, args.limit), queries)
+    # vocabulary[0] is in most posts and gets skipped, the next few are common but still scored
+    results["index_common_term_ms"] = median_ms(lambda query: index.search(query, args.limit), vocabulary[1:6])
+    start = time.perf_counter()
+    for post_id in range(1, 1001):
+        index.add(post_id, "updated title", "updated content")
+    results["index_update_1000_posts_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    if not args.skip_like:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(models.User), [{"email": "bench@example.com", "password": "x"}])
+            batch = []
+            for post_id, title, content in synthetic_posts(args.posts, vocabulary):
+                batch.append({"id": post_id, "title": title, "content": content, "owner_id": 1})
+                if len(batch) == 50000:
+                    conn.execute(insert(models.Post), batch)
+                    batch = []
+            if batch:
+                conn.execute(insert(models.Post), batch)
+
+        with engine.connect() as conn:
+            def like(query):
+                conn.execute(select(models.Post.id).filter(models.Post.title.contains(query))
+                             .order_by(models.Post.id.desc()).limit(args.limit)).all()
+            # a rare term has to scan the whole table before LIMIT is satisfied
+            results["like_query_p50_ms"] = median_ms(like, queries[:20])
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# POST /vote/ throughput with votes applied one transaction per request (the default) and through the
+# write-behind buffer (VOTE_BUFFER=true), with and without its fsync'd intent log. Each mode gets a
+# freshly seeded SQLite database, and a buffered run includes its final flush, so every mode ends
+# with every vote written.
+#
+#   python -m benchmarks.vote_buffer --users 200 --posts 1000 --requests 5000 --concurrency 50
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+from sqlalchemy import create_engine, func, select
+
+from app import models, vote_buffer
+from app.main import app
+from app.oauth2 import create_access_token, principal_cache
+from app.vote_buffer import VoteBuffer
+from benchmarks.load import seed, use_database
+
+
+async def drive(requests, concurrency, users, posts, seed_value):
+    rng = random.Random(seed_value)
+    votes = [(rng.randint(1, users), rng.randint(1, posts), rng.choice((0, 1, 1))) for _ in range(requests)]
+    headers = {user_id: {"Authorization": f"Bearer {create_access_token({'user_id': user_id})}"} for user_id in range(1, users + 1)}
+    queue = asyncio.Queue()
+    for vote in votes:
+        queue.put_nowait(vote)
+    statuses = Counter()
+
+    async def worker(client):
+        while not queue.empty():
+            user_id, post_id, direction = queue.get_nowait()
+            res = await client.post("/vote/", json={"post_id": post_id, "dir": direction}, headers=headers[user_id])
+            statuses[res.status_code] += 1
+
+    async with httpx.AsyncClient(app=app, base_url="http://benchmark") as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return statuses
+
+
+async def run(mode, args, directory):
+    url = f"sqlite:///{directory}/{mode}.db"
+    seed(url, args.users, args.posts, 0, args.seed)
+    use_database(url)
+    principal_cache.clear()
+    buffer = None
+    if mode != "direct":
+        log_path = os.path.join(directory, f"{mode}.log") if mode == "buffered_log" else ""
+        buffer = VoteBuffer(max_size=args.max_size, flush_seconds=args.flush_seconds, log_path=log_path)
+        await buffer.start()
+    vote_buffer.buffer = buffer
+
+    start = time.perf_counter()
+    statuses = await drive(args.requests, args.concurrency, args.users, args.posts, args.seed)
+    if buffer is not None:
+        await buffer.stop()
+    elapsed = time.perf_counter() - start
+    vote_buffer.buffer = None
+
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        rows = conn.scalar(select(func.count()).select_from(models.Vote))
+        drift = conn.scalar(select(func.count()).select_from(models.Post).where(
+            models.Post.votes_count != select(func.count()).where(models.Vote.post_id == models.Post.id).scalar_subquery()))
+    engine.dispose()
+    result = {"votes_per_s": round(args.requests / elapsed, 1), "seconds": round(elapsed, 2),
+              "statuses": dict(sorted(statuses.items())), "vote_rows": rows, "drifted_counts": drift}
+    if buffer is not None:
+        result["flushes"] = buffer.flushes
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--max-size", type=int, default=1000)
+    parser.add_argument("--flush-seconds", type=float, default=0.5)
+    parser.add_argument("--modes", default="direct,buffered,buffered_log")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in args.modes.split(","):
+            results[mode] = asyncio.run(run(mode, args, directory))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
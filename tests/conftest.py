@@ -1,43 +1,86 @@
+import os
 from fastapi.testclient import TestClient
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
 from app.main import app
-from app.config import settings
-from app.database import get_db, Base
-from app.oauth2 import create_access_token
-from app import models
+from app.database import get_db, Base, LazySession, make_engine, track
+from app.oauth2 import create_access_token, principal_cache
+from app import models, response_cache, utils
 # from alembic import command
 
 
-SQLALCHEMY_DATABASE_URL = f"mysql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}_test"
+# bcrypt's minimum cost: every test creates users, and their hashes don't need to resist anything.
+# Set before the hash worker processes start; they are handed it when they do
+utils.pwd_context.update(bcrypt__rounds=4)
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# a SQLite file by default, so the suite needs no server; TEST_DATABASE_URL points it at e.g. MySQL
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
 
-TestingSessionLocal = sessionmaker(autoflush=False, bind=engine)
+def worker_database_url(tmp_path_factory):
+    # one database per pytest-xdist worker (gw0, gw1, ...), so workers running in parallel never meet
+    if not TEST_DATABASE_URL:
+        return f"sqlite:///{tmp_path_factory.mktemp('database')}/test.db"
+    url = make_url(TEST_DATABASE_URL)
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker is None or url.get_backend_name() == "sqlite":
+        return url
+    url = url.set(database=f"{url.database}_{worker}")
+    if url.get_backend_name() == "mysql":
+        server = create_engine(url.set(database=""))
+        with server.connect() as conn:
+            conn.exec_driver_sql(f"CREATE DATABASE IF NOT EXISTS `{url.database}`")
+        server.dispose()
+    return url
 
-@pytest.fixture(scope='function')
-def session():
+@pytest.fixture(scope='session')
+def engine(tmp_path_factory):
+    engine = make_engine(worker_database_url(tmp_path_factory))
+    if engine.dialect.name == "sqlite":
+        # pysqlite's own transaction handling breaks SAVEPOINT, so SQLAlchemy emits BEGIN itself
+        event.listen(engine, "connect", lambda dbapi_connection, record: setattr(dbapi_connection, "isolation_level", None))
+        event.listen(engine, "begin", lambda conn: conn.exec_driver_sql("BEGIN"))
+    # the schema is built once per run
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
     # command.downgrade("base")
     # command.upgrade("head")
-    db = TestingSessionLocal()
+    yield engine
+    engine.dispose()
+
+@pytest.fixture(autouse=True)
+def clear_response_cache(monkeypatch):
+    # the tests run the app in one process, where the memory backend is safe to turn on; every test
+    # starts from an empty database, so it gets an empty cache too
+    monkeypatch.setattr(response_cache, "backend", response_cache.make_backend("memory"))
+
+@pytest.fixture(scope='function')
+def session(engine):
+    # each test runs inside one transaction that is rolled back afterwards; the session's commit()
+    # only releases a SAVEPOINT, so the app's commits stay visible until the test ends
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = Session(bind=connection, autoflush=False, join_transaction_mode="create_savepoint")
     try:
         yield db
     finally:
         db.close()
+        transaction.rollback()
+        connection.close()
 
 @pytest.fixture(scope='function')
 def client(session):
     # run our code before we return our test
-    def override_get_db():
+    async def override_get_db():
+        # released when the endpoint returns, like the real get_db
+        db = track(LazySession(lambda: session))
         try:
-            yield session
+            yield db
         finally:
-            session.close()
+            await db.release()
     app.dependency_overrides[get_db] = override_get_db
+    principal_cache.clear()
     yield TestClient(app)
     # run our code after our test finishes
 
@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+from app.main import app
+from app.database import get_db, Base
+from app import schemas
+from app.oauth2 import principal_cache
+
+# aiosqlite stands in for aiomysql so the AsyncSession code path runs without a server
+
+
+@pytest.fixture
+def async_client(tmp_path):
+    # TestClient runs each request on its own event loop, so connections can't be pooled across them
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/async_test.db", poolclass=NullPool)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    AsyncTestingSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    principal_cache.clear()
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture
+def async_authorized_client(async_client):
+    user_data = {"email": "async@gmail.com", "password": "password123"}
+    res = async_client.post("/users/", json=user_data)
+    assert res.status_code == 201
+
+    res = async_client.post("/login", data={"username": user_data["email"], "password": user_data["password"]})
+    assert res.status_code == 200
+    async_client.headers = {
+        **async_client.headers,
+        "Authorization": f"Bearer {res.json()['access_token']}"
+    }
+    return async_client
+
+
+def test_async_create_and_get_post(async_authorized_client):
+    res = async_authorized_client.post("/posts/", json={"title": "async title", "content": "async content"})
+    assert res.status_code == 201
+    created_post = schemas.Post(**res.json())
+    assert created_post.owner.email == "async@gmail.com"
+
+    res = async_authorized_client.get(f"/posts/{created_post.id}")
+    assert res.status_code == 200
+    post = schemas.PostOut(**res.json())
+    assert post.Post.title == "async title"
+    assert post.votes == 0
+
+
+def test_async_list_posts_with_votes(async_authorized_client):
+    for i in range(3):
+        async_authorized_client.post("/posts/", json={"title": f"title {i}", "content": "content"})
+    post_id = async_authorized_client.get("/posts/").json()[0]["Post"]["id"]
+
+    res = async_authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    assert res.status_code == 201
+    res = async_authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    assert res.status_code == 409
+
+    res = async_authorized_client.get("/posts/")
+    posts = [schemas.PostOut(**post) for post in res.json()]
+    assert len(posts) == 3
+    assert {post.Post.id: post.votes for post in posts}[post_id] == 1
+
+
+def test_async_update_and_delete_post(async_authorized_client):
+    post_id = async_authorized_client.post("/posts/", json={"title": "old", "content": "old"}).json()["id"]
+
+    res = async_authorized_client.put(f"/posts/{post_id}", json={"title": "new", "content": "new"})
+    assert res.status_code == 200
+    assert schemas.Post(**res.json()).title == "new"
+
+    res = async_authorized_client.delete(f"/posts/{post_id}")
+    assert res.status_code == 204
+    res = async_authorized_client.get(f"/posts/{post_id}")
+    assert res.status_code == 404
@@ -0,0 +1,9 @@
+import pytest
+from pydantic import ValidationError
+from app.config import Settings
+
+
+def test_database_settings_required():
+    with pytest.raises(ValidationError, match="missing: DATABASE_PORT, DATABASE_PASSWORD"):
+        Settings(_env_file=None, database_url="", database_port="", database_password="")
+    assert Settings(_env_file=None, database_url="sqlite:///./app.db", database_port="").database_url == "sqlite:///./app.db"
@@ -0,0 +1,83 @@
+import threading
+import time
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from app.main import app
+from app.database import get_db, TimedQueuePool, ThreadedSession, pool_status
+
+POOL_SIZE = 2
+MAX_OVERFLOW = 1
+
+
+@pytest.fixture
+def pool_engine(tmp_path):
+    # a sqlite file stands in for MySQL, the pool behaviour is the same
+    engine = create_engine(f"sqlite:///{tmp_path}/pool.db", connect_args={"check_same_thread": False},
+                           poolclass=TimedQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                           pool_timeout=10, pool_pre_ping=True)
+    yield engine
+    engine.dispose()
+
+
+def test_pool_under_ten_times_concurrency(pool_engine):
+    workers = (POOL_SIZE + MAX_OVERFLOW) * 10
+    peak = []
+    errors = []
+
+    def request():
+        try:
+            with pool_engine.connect() as conn:
+                peak.append(pool_engine.pool.checkedout())
+                conn.execute(text("SELECT 1"))
+                time.sleep(0.02)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=request) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    status = pool_status(pool_engine.pool)
+    assert errors == []
+    assert max(peak) <= POOL_SIZE + MAX_OVERFLOW
+    assert status["checked_out"] == 0
+    assert status["idle"] == POOL_SIZE
+    assert status["waits"] == workers
+    assert status["timeouts"] == 0
+    # most callers had to queue for a connection
+    assert status["wait_seconds_max"] > 0.02
+
+
+def test_pool_timeout_returns_503(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/pool.db", connect_args={"check_same_thread": False},
+                           poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+    SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+    def override_get_db():
+        session = SessionLocal()
+        try:
+            yield ThreadedSession(session)
+        finally:
+            session.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        with engine.connect():
+            # the only connection is busy, so the user lookup has to wait and gives up
+            res = TestClient(app).get("/users/1")
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "1"
+        assert pool_status(engine.pool)["timeouts"] == 1
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        engine.dispose()
+
+
+def test_metrics_reports_pool(client):
+    res = client.get("/metrics/")
+    assert res.status_code == 200
+    assert {"size", "checked_out", "idle", "overflow", "waits", "timeouts"} <= set(res.json()["pool"])
@@ -1,6 +1,17 @@
+import asyncio
+import csv
+import io
+import json
+import tracemalloc
 from typing import List
-from app import schemas
+from app import database, models, schemas, search, response_cache
+from app.oauth2 import create_access_token
+from app.config import settings
 import pytest
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import joinedload
+from app.database import ThreadedSession
+from app.routers.post import export_chunks, post_out_columns
 
 def test_get_all_posts(authorized_client, test_posts):
     res = authorized_client.get("/posts/")
@@ -107,3 +118,432 @@ def test_update_post_non_exists(authorized_client, test_user, test_posts):
     }
     res = authorized_client.put(f"/posts/8000000", json=data)
     assert res.status_code == 404
+
+def test_get_posts_cursor_pagination(authorized_client, test_posts):
+    # an empty cursor starts at the newest post
+    res = authorized_client.get("/posts/?limit=2&cursor=")
+    assert res.status_code == 200
+    first_page = [post["Post"]["id"] for post in res.json()]
+    assert len(first_page) == 2
+    cursor = res.headers["X-Next-Cursor"]
+
+    res = authorized_client.get(f"/posts/?limit=2&cursor={cursor}")
+    second_page = [post["Post"]["id"] for post in res.json()]
+    assert len(second_page) == 2
+    assert set(first_page).isdisjoint(second_page)
+    assert sorted(first_page + second_page, reverse=True) == first_page + second_page
+
+    res = authorized_client.get(f"/posts/?limit=2&cursor={res.headers['X-Next-Cursor']}")
+    assert res.json() == []
+    assert "X-Next-Cursor" not in res.headers
+
+def test_get_posts_skip_matches_cursor(authorized_client, test_posts):
+    # skip pages keep the original oldest-first order, and their cursors continue in it
+    first_page = authorized_client.get("/posts/?limit=2")
+    assert [post["Post"]["id"] for post in first_page.json()] == [post.id for post in test_posts[:2]]
+    by_cursor = authorized_client.get(f"/posts/?limit=2&cursor={first_page.headers['X-Next-Cursor']}").json()
+    by_skip = authorized_client.get("/posts/?limit=2&skip=2").json()
+    assert by_cursor == by_skip
+    assert [post["Post"]["id"] for post in by_skip] == [post.id for post in test_posts[2:4]]
+
+def test_get_posts_invalid_cursor(authorized_client, test_posts):
+    res = authorized_client.get("/posts/?cursor=not-a-cursor")
+    assert res.status_code == 400
+
+@pytest.fixture
+def memory_search(monkeypatch, test_posts):
+    monkeypatch.setattr(settings, "search_backend", "memory")
+    search.search_index.clear()
+    for post in test_posts:
+        search.index_post(post)
+    yield search.search_index
+    search.search_index.clear()
+
+def test_search_memory_index_ranked(authorized_client, memory_search):
+    authorized_client.post("/posts/", json={"title": "rust tips", "content": "borrow checker"})
+    authorized_client.post("/posts/", json={"title": "python tips", "content": "python python"})
+    authorized_client.post("/posts/", json={"title": "cooking", "content": "python recipes"})
+
+    res = authorized_client.get("/posts/?search=python")
+    assert res.status_code == 200
+    titles = [post["Post"]["title"] for post in res.json()]
+    assert titles == ["python tips", "cooking"]
+
+def test_search_memory_index_follows_update_and_delete(authorized_client, test_posts, memory_search):
+    post_id = test_posts[0].id
+    assert [post["Post"]["id"] for post in authorized_client.get("/posts/?search=1st").json()] == [post_id]
+
+    authorized_client.put(f"/posts/{post_id}", json={"title": "renamed", "content": "changed"})
+    assert authorized_client.get("/posts/?search=1st").json() == []
+    assert len(authorized_client.get("/posts/?search=renamed").json()) == 1
+
+    authorized_client.delete(f"/posts/{post_id}")
+    assert authorized_client.get("/posts/?search=renamed").json() == []
+    assert post_id not in memory_search.documents
+
+def test_search_memory_index_pages_by_offset(authorized_client, memory_search):
+    res = authorized_client.get("/posts/?search=title&limit=3")
+    assert len(res.json()) == 3
+    res = authorized_client.get(f"/posts/?search=title&limit=3&cursor={res.headers['X-Next-Cursor']}")
+    assert len(res.json()) == 1
+
+
+def test_get_posts_served_from_response_cache(authorized_client, test_posts):
+    res = authorized_client.get("/posts/")
+    assert res.status_code == 200
+    assert authorized_client.get("/metrics/").json()["response_cache"]["misses"] >= 1
+
+    res2 = authorized_client.get("/posts/")
+    assert res2.content == res.content
+    assert res2.headers["ETag"] == res.headers["ETag"]
+    assert authorized_client.get("/metrics/").json()["response_cache"]["hits"] == 1
+
+def test_get_post_not_modified(authorized_client, test_posts):
+    res = authorized_client.get(f"/posts/{test_posts[0].id}")
+    etag = res.headers["ETag"]
+
+    res = authorized_client.get(f"/posts/{test_posts[0].id}", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+    assert res.headers["ETag"] == etag
+
+def test_response_cache_invalidated_by_writes(authorized_client, test_posts):
+    post_id = test_posts[3].id
+    listing = authorized_client.get("/posts/")
+    detail = authorized_client.get(f"/posts/{post_id}")
+
+    authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    res = authorized_client.get(f"/posts/{post_id}", headers={"If-None-Match": detail.headers["ETag"]})
+    assert res.status_code == 200
+    assert res.json()["votes"] == 1
+    assert {post["Post"]["id"]: post["votes"] for post in authorized_client.get("/posts/").json()}[post_id] == 1
+
+    authorized_client.put(f"/posts/{test_posts[0].id}", json={"title": "updated title", "content": "updated content"})
+    assert authorized_client.get(f"/posts/{test_posts[0].id}").json()["Post"]["title"] == "updated title"
+
+    authorized_client.post("/posts/", json={"title": "new post", "content": "new content"})
+    res = authorized_client.get("/posts/")
+    assert len(res.json()) == len(listing.json()) + 1
+    assert res.headers["ETag"] != listing.headers["ETag"]
+
+def test_memory_cache_drops_tags_of_evicted_entries():
+    backend = response_cache.MemoryBackend(maxsize=1, ttl=30)
+
+    async def fill():
+        for post_id in range(11):
+            await backend.set(f"post:{post_id}", b"{}", [f"post:{post_id}"], 0)
+
+    asyncio.run(fill())
+    assert backend.entries.keys() == {"post:10"}
+    assert set(backend.tags) == {"post:10"}
+
+def test_response_computed_before_invalidation_is_not_stored():
+    backend = response_cache.MemoryBackend(maxsize=10, ttl=30)
+
+    async def race():
+        started = await backend.begin()
+        # another request writes the post while this one is still building its response
+        await backend.invalidate(["post:1"])
+        await backend.set("post:1", b"{}", ["post:1"], started)
+        stale = await backend.get("post:1")
+        await backend.set("post:1", b"{}", ["post:1"], await backend.begin())
+        return stale, await backend.get("post:1")
+
+    assert asyncio.run(race()) == (None, b"{}")
+
+@pytest.fixture
+def count_statements(session):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # the savepoints are the test session's, not the app's
+        if not statement.startswith(database.TRANSACTION_CONTROL):
+            statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(engine, "before_cursor_execute", record)
+
+@pytest.mark.parametrize("strategy, expected", [("joined", 1), ("selectin", 2)])
+def test_get_posts_loads_owners_in_bounded_statements(authorized_client, test_posts, count_statements, monkeypatch, strategy, expected):
+    monkeypatch.setattr(settings, "post_list_owner_loading", strategy)
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")  # caches the principal
+    count_statements.clear()
+
+    res = authorized_client.get("/posts/")
+    assert {post["Post"]["owner"]["email"] for post in res.json()} == {"hello123@gmail.com", "hello456@gmail.com"}
+    assert len(count_statements) == expected
+
+@pytest.mark.parametrize("strategy, expected", [("joined", 1), ("selectin", 2)])
+def test_get_post_loads_owner_in_bounded_statements(authorized_client, test_posts, count_statements, monkeypatch, strategy, expected):
+    monkeypatch.setattr(settings, "post_detail_owner_loading", strategy)
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    res = authorized_client.get(f"/posts/{test_posts[0].id}")
+    assert res.json()["Post"]["owner"]["email"] == "hello123@gmail.com"
+    assert len(count_statements) == expected
+
+def test_fast_json_matches_schema_output(authorized_client, test_posts, session, test_user, monkeypatch):
+    session.add(models.Post(title='naïve "quotes" \\ 日本語', content="line\nbreak\ttab   😀", published=False, owner_id=test_user['id']))
+    session.commit()
+    monkeypatch.setattr(response_cache, "backend", None)
+
+    urls = ["/posts/?limit=100", f"/posts/{test_posts[0].id}", "/posts/?fields=time,owner,votes", "/posts/?content_preview=6"]
+    expected = [authorized_client.get(url).content for url in urls]
+    monkeypatch.setattr(settings, "fast_json", True)
+    assert [authorized_client.get(url).content for url in urls] == expected
+
+def test_sparse_fields_documented_in_openapi(authorized_client, test_posts):
+    schema = authorized_client.get("/openapi.json").json()
+    listing = schema["paths"]["/posts/"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert {option["items"]["$ref"] for option in listing["anyOf"]} == {"#/components/schemas/PostOut", "#/components/schemas/SparsePostOut"}
+    assert "required" not in schema["components"]["schemas"]["SparsePost"]
+
+    posts = authorized_client.get("/posts/?fields=id,votes").json()
+    assert [schemas.SparsePostOut(**post).Post.title for post in posts] == [None] * len(test_posts)
+
+def test_sparse_fields_load_only_requested_columns(authorized_client, test_posts, count_statements, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    res = authorized_client.get("/posts/?fields=id,title,votes")
+    assert res.status_code == 200
+    assert [post["Post"]["id"] for post in res.json()] == sorted(post.id for post in test_posts)
+    assert all(set(post) == {"Post", "votes"} and set(post["Post"]) == {"id", "title"} for post in res.json())
+    # one statement, without the content column or the owner join
+    [statement] = count_statements
+    assert "posts.content" not in statement
+    assert "users" not in statement
+
+    assert set(authorized_client.get("/posts/?fields=owner").json()[0]["Post"]) == {"owner"}
+    assert authorized_client.get("/posts/?fields=id,password").status_code == 400
+    assert authorized_client.get("/posts/?fields=,").status_code == 400
+
+def test_content_preview_truncates_in_sql(authorized_client, test_posts, count_statements, monkeypatch):
+    contents = {post.id: post.content for post in test_posts}
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    res = authorized_client.get("/posts/?fields=id,content&content_preview=3")
+    assert {post["Post"]["id"]: post["Post"]["content"] for post in res.json()} == {id: content[:3] for id, content in contents.items()}
+    assert "substr" in count_statements[0].lower()
+
+    # every field, content cut down
+    post = authorized_client.get("/posts/?content_preview=3").json()[0]
+    assert post["Post"]["content"] == contents[post["Post"]["id"]][:3]
+    assert post["Post"]["owner"]["email"] and post["votes"] == 0
+
+def test_voted_flag_is_per_user(authorized_client, test_posts, test_user2):
+    voted, other = test_posts[0].id, test_posts[1].id
+    other_user = {"Authorization": f"Bearer {create_access_token({'user_id': test_user2['id']})}"}
+    # cached by the other user's request first; the cached responses are shared
+    assert not any(post["voted"] for post in authorized_client.get("/posts/", headers=other_user).json())
+
+    assert authorized_client.post("/vote/", json={"post_id": voted, "dir": 1}).status_code == 201
+    flags = {post["Post"]["id"]: post["voted"] for post in authorized_client.get("/posts/").json()}
+    assert flags[voted] is True and flags[other] is False
+    assert authorized_client.get(f"/posts/{voted}").json()["voted"] is True
+    assert [post["voted"] for post in authorized_client.get(f"/posts/batch?ids={voted},{other}").json()] == [True, False]
+    assert [post["voted"] for post in authorized_client.get("/posts/?fields=id,voted&limit=100").json() if post["Post"]["id"] == voted] == [True]
+
+    assert authorized_client.get(f"/posts/{voted}", headers=other_user).json()["voted"] is False
+    assert not any(post["voted"] for post in authorized_client.get("/posts/", headers=other_user).json())
+
+def test_voted_flag_costs_no_extra_statement(authorized_client, test_user, session, count_statements, monkeypatch):
+    session.execute(insert(models.Post), [{"title": f"title {i}", "content": "content", "owner_id": test_user["id"]} for i in range(100)])
+    post_ids = session.scalars(select(models.Post.id)).all()
+    session.execute(insert(models.Vote), [{"post_id": post_id, "user_id": test_user["id"]} for post_id in post_ids[::2]])
+    session.commit()
+    monkeypatch.setattr(settings, "post_list_owner_loading", "joined")
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    posts = authorized_client.get("/posts/?limit=100").json()
+    assert len(posts) == 100
+    assert sum(post["voted"] for post in posts) == 50
+    assert len(count_statements) == 1
+
+def test_cached_posts_are_shared_between_users(authorized_client, test_posts, test_user2, count_statements):
+    voted = test_posts[0].id
+    other_user = {"Authorization": f"Bearer {create_access_token({'user_id': test_user2['id']})}"}
+    authorized_client.post("/vote/", json={"post_id": voted, "dir": 1})
+    authorized_client.get("/posts/", headers=other_user)
+    authorized_client.get(f"/posts/{voted}", headers=other_user)
+    hits = authorized_client.get("/metrics/").json()["response_cache"]["hits"]
+    count_statements.clear()
+
+    flags = {post["Post"]["id"]: post["voted"] for post in authorized_client.get("/posts/").json()}
+    assert flags[voted] is True and not any(flag for post_id, flag in flags.items() if post_id != voted)
+    detail = authorized_client.get(f"/posts/{voted}")
+    assert detail.json()["voted"] is True
+    assert authorized_client.get("/metrics/").json()["response_cache"]["hits"] == hits + 2
+    # one SELECT post_id FROM votes per response, whatever the page size
+    assert [statement.startswith("SELECT votes.post_id") for statement in count_statements] == [True, True]
+
+    # the ETag covers the user's flags, so one user's copy doesn't validate another's
+    res = authorized_client.get(f"/posts/{voted}", headers={**other_user, "If-None-Match": detail.headers["ETag"]})
+    assert res.status_code == 200 and res.json()["voted"] is False
+
+def test_export_posts_ndjson(authorized_client, test_posts, test_user):
+    res = authorized_client.get("/posts/export")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    posts = [schemas.PostOut(**json.loads(line)) for line in res.text.splitlines()]
+    assert [post.Post.id for post in posts] == sorted(post.id for post in test_posts)
+    assert posts[0].Post.owner.email == test_user["email"]
+
+    res = authorized_client.get(f"/posts/export?owner_id={test_user['id']}&after_id={test_posts[0].id}")
+    assert [json.loads(line)["Post"]["id"] for line in res.text.splitlines()] == [post.id for post in test_posts[1:3]]
+
+    assert authorized_client.get("/posts/export?published=false").text == ""
+    assert authorized_client.get("/posts/export?until=2000-01-01T00:00:00").text == ""
+
+def test_export_posts_csv(authorized_client, test_posts):
+    res = authorized_client.get("/posts/export?format=csv")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+    assert [int(row["id"]) for row in rows] == sorted(post.id for post in test_posts)
+    assert rows[0]["owner_email"] == "hello123@gmail.com"
+    assert rows[0]["votes"] == "0"
+
+    assert authorized_client.get("/posts/export?format=xml").status_code == 422
+
+def test_export_memory_stays_flat(session, test_user):
+    def seed(count):
+        session.execute(insert(models.Post), [{"title": f"title {i}", "content": "content " * 20, "owner_id": test_user["id"]}
+                                              for i in range(count)])
+        session.commit()
+
+    async def export():
+        exported = 0
+        async for chunk in export_chunks(ThreadedSession(session), select(*post_out_columns(test_user["id"]))
+                                         .options(joinedload(models.Post.owner)).order_by(models.Post.id), "ndjson", batch_size=500):
+            exported += chunk.count(b"\n")
+        return exported
+
+    def peak_memory():
+        tracemalloc.start()
+        try:
+            exported = asyncio.run(export())
+            return exported, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    seed(2000)
+    small_rows, small_peak = peak_memory()
+    seed(18000)
+    large_rows, large_peak = peak_memory()
+
+    assert (small_rows, large_rows) == (2000, 20000)
+    # ten times the rows, about the same peak: only one batch is ever held
+    assert large_peak < small_peak * 1.5
+
+def test_get_posts_batch(authorized_client, test_posts, count_statements, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    ids = [test_posts[2].id, 8888888, test_posts[0].id, test_posts[2].id]
+    res = authorized_client.get(f"/posts/batch?ids={','.join(map(str, ids))}")
+    assert res.status_code == 200
+    posts = [schemas.PostOut(**post) for post in res.json()]
+    assert [post.Post.id for post in posts] == [test_posts[2].id, test_posts[0].id]
+    assert posts[0].Post.owner.email == "hello123@gmail.com"
+    assert len(count_statements) == 1
+
+def test_get_posts_batch_rejects_bad_ids(authorized_client, test_posts, monkeypatch):
+    assert authorized_client.get("/posts/batch?ids=1,two").status_code == 400
+    monkeypatch.setattr(settings, "post_batch_max_ids", 2)
+    assert authorized_client.get("/posts/batch?ids=1,2,3").status_code == 400
+
+def test_create_posts_bulk(authorized_client, test_user, test_posts):
+    items = [{"title": "bulk 1", "content": "content"}, {"title": "bulk 2"}, {"title": "bulk 3", "content": "content", "published": False}, "nonsense"]
+    res = authorized_client.post("/posts/bulk", json=items)
+    assert res.status_code == 201
+    body = schemas.PostBulkOut(**res.json())
+    assert (body.created, body.failed) == (2, 2)
+    assert [item.errors is None for item in body.items] == [True, False, True, False]
+    assert body.items[1].errors[0]["loc"] == ["content"]
+
+    created = [authorized_client.get(f"/posts/{item.id}").json()["Post"] for item in body.items if item.id]
+    assert [(post["title"], post["published"], post["owner_id"]) for post in created] == [("bulk 1", True, test_user["id"]), ("bulk 3", False, test_user["id"])]
+    assert len(authorized_client.get("/posts/?limit=100").json()) == len(test_posts) + 2
+
+def test_create_posts_bulk_all_invalid(authorized_client, test_posts, monkeypatch):
+    res = authorized_client.post("/posts/bulk", json=[{"title": "no content"}])
+    assert res.status_code == 422
+    assert res.json()["created"] == 0
+
+    monkeypatch.setattr(settings, "post_bulk_max_items", 2)
+    assert authorized_client.post("/posts/bulk", json=[{"title": "t", "content": "c"}] * 3).status_code == 413
+
+def test_create_posts_bulk_body_size_limit(authorized_client, test_posts, monkeypatch):
+    body = json.dumps([{"title": "t", "content": "c" * 100}] * 3).encode()
+    monkeypatch.setattr(settings, "post_bulk_max_bytes", len(body) - 1)
+    headers = {"Content-Type": "application/json"}
+    assert authorized_client.post("/posts/bulk", content=body, headers=headers).status_code == 413
+    # a chunked body has no Content-Length, so it is cut off while it is read
+    assert authorized_client.post("/posts/bulk", content=iter([body[:100], body[100:]]), headers=headers).status_code == 413
+
+    monkeypatch.setattr(settings, "post_bulk_max_bytes", len(body))
+    res = authorized_client.post("/posts/bulk", content=iter([body[:100], body[100:]]), headers=headers)
+    assert res.status_code == 201
+    assert res.json()["created"] == 3
+
+def test_update_post_single_statement(authorized_client, test_posts, count_statements):
+    authorized_client.get("/posts/?limit=1")
+    count_statements.clear()
+
+    res = authorized_client.put(f"/posts/{test_posts[0].id}", json={"title": "updated title", "content": "updated content"})
+    assert res.status_code == 200
+    assert res.json()["version"] == 2
+    # the UPDATE and one SELECT to return the post with its owner
+    assert [statement.split()[0] for statement in count_statements] == ["UPDATE", "SELECT"]
+
+def test_patch_post(authorized_client, test_posts):
+    own_id, other_id = test_posts[0].id, test_posts[3].id
+    res = authorized_client.patch(f"/posts/{own_id}", json={"published": False})
+    assert res.status_code == 200
+    post = schemas.Post(**res.json())
+    assert (post.title, post.content, post.published, post.version) == ("1st title", "1st content", False, 2)
+
+    assert authorized_client.patch(f"/posts/{own_id}", json={"title": None}).status_code == 422
+    assert authorized_client.patch(f"/posts/{other_id}", json={"title": "mine"}).status_code == 403
+    assert authorized_client.patch("/posts/8000000", json={"title": "mine"}).status_code == 404
+
+def test_update_post_if_match(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    version = authorized_client.get(f"/posts/{post_id}").json()["Post"]["version"]
+
+    res = authorized_client.patch(f"/posts/{post_id}", json={"title": "first editor"}, headers={"If-Match": f'"{version}"'})
+    assert res.status_code == 200
+    # a second editor still holding the old version loses
+    res = authorized_client.patch(f"/posts/{post_id}", json={"title": "second editor"}, headers={"If-Match": f'"{version}"'})
+    assert res.status_code == 412
+    assert authorized_client.delete(f"/posts/{post_id}", headers={"If-Match": f'"{version}"'}).status_code == 412
+    assert authorized_client.get(f"/posts/{post_id}").json()["Post"]["title"] == "first editor"
+
+    assert authorized_client.patch(f"/posts/{post_id}", json={"title": "x"}, headers={"If-Match": "nonsense"}).status_code == 400
+    assert authorized_client.delete(f"/posts/{post_id}", headers={"If-Match": f'"{version + 1}"'}).status_code == 204
+
+def test_update_post_with_detail_etag(authorized_client, test_posts):
+    post_id = test_posts[0].id
+    etag = authorized_client.get(f"/posts/{post_id}").headers["ETag"]
+    # a vote changes the body (and the ETag) but not the version the edit is checked against
+    authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    assert authorized_client.get(f"/posts/{post_id}", headers={"If-None-Match": etag}).status_code == 200
+
+    res = authorized_client.patch(f"/posts/{post_id}", json={"title": "edited"}, headers={"If-Match": etag})
+    assert res.status_code == 200
+    assert authorized_client.patch(f"/posts/{post_id}", json={"title": "stale"}, headers={"If-Match": etag}).status_code == 412
+
+    etag = authorized_client.get(f"/posts/{post_id}").headers["ETag"]
+    assert authorized_client.delete(f"/posts/{post_id}", headers={"If-Match": etag}).status_code == 204
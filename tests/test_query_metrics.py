@@ -0,0 +1,78 @@
+import json
+import logging
+from fastapi import routing
+from app import response_cache
+from app.config import settings
+from app.routers.metrics import route_metrics
+
+
+def test_db_query_headers(authorized_client, test_posts, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", None)
+    authorized_client.get("/posts/?limit=1")  # caches the principal
+
+    res = authorized_client.get(f"/posts/{test_posts[0].id}")
+    # post and owner in one joined SELECT
+    assert res.headers["X-DB-Queries"] == "1"
+    assert res.headers["Server-Timing"].startswith("db;dur=")
+    assert res.headers["Server-Timing"].endswith('desc="1 queries"')
+
+    res = authorized_client.get("/")
+    assert res.headers["X-DB-Queries"] == "0"
+
+
+def test_slow_query_log(authorized_client, test_posts, monkeypatch, caplog):
+    monkeypatch.setattr(settings, "slow_query_ms", 0.000001)
+    with caplog.at_level(logging.WARNING, logger="app.slow_query"):
+        authorized_client.get(f"/posts/{test_posts[0].id}")
+
+    entries = [json.loads(record.getMessage()) for record in caplog.records if record.name == "app.slow_query"]
+    assert entries
+    assert entries[-1]["event"] == "slow_query"
+    assert entries[-1]["request"] == f"GET /posts/{test_posts[0].id}"
+    assert entries[-1]["statement"].startswith("SELECT")
+    assert entries[-1]["duration_ms"] >= 0
+
+
+def test_route_histograms_in_metrics(authorized_client, test_posts, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", None)
+    route_metrics.clear()
+    for post in test_posts:
+        authorized_client.get(f"/posts/{post.id}")
+
+    routes = authorized_client.get("/metrics/").json()["routes"]
+    detail = routes["GET /posts/{id}"]
+    assert detail["requests"] == len(test_posts)
+    assert detail["queries"]["buckets"]["+Inf"] == len(test_posts)
+    assert detail["queries"]["max"] >= 1
+    assert detail["slowest"]["statement"].startswith("SELECT")
+    assert "GET /posts/1" not in routes
+
+
+def test_session_released_before_serialization(authorized_client, session, monkeypatch):
+    in_transaction = []
+    serialize_response = routing.serialize_response
+
+    async def spy(**kwargs):
+        in_transaction.append(session.in_transaction())
+        return await serialize_response(**kwargs)
+
+    monkeypatch.setattr(routing, "serialize_response", spy)
+    res = authorized_client.post("/posts/", json={"title": "title", "content": "content"})
+    assert res.status_code == 201
+    assert res.json()["owner"]["email"] == "hello123@gmail.com"
+    assert in_transaction == [False]
+
+
+def test_session_hold_in_metrics(authorized_client):
+    route_metrics.clear()
+    authorized_client.post("/posts/", json={"title": "title", "content": "content"})
+    # rejected before anything touches the database, so no session is opened
+    res = authorized_client.post("/posts/", json={"title": "title", "content": "content"}, headers={"Authorization": "Bearer invalid"})
+    assert res.status_code == 401
+
+    routes = authorized_client.get("/metrics/").json()["routes"]
+    created = routes["POST /posts/"]
+    assert created["requests"] == 2
+    assert created["session_ms"]["buckets"]["+Inf"] == 1
+    assert created["session_saved_ms"]["buckets"]["+Inf"] == 1
+    assert created["session_saved_ms"]["sum"] >= 0
@@ -0,0 +1,104 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.main import app
+from app.database import get_db, Base, ThreadedSession, Replica, ReplicaRouter
+from app.oauth2 import create_access_token, principal_cache
+from app import database, models, response_cache
+
+# three sqlite files stand in for a primary and two replicas; each replica gets its own
+# post so a response shows which database served it
+
+
+def seed(url, post_title):
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add(models.User(email="hello123@gmail.com", password="x"))
+        db.add(models.User(email="hello456@gmail.com", password="x"))
+        db.flush()
+        db.add(models.Post(title=post_title, content="content", owner_id=1))
+        db.commit()
+    engine.dispose()
+
+
+@pytest.fixture
+def replica_client(tmp_path, monkeypatch):
+    primary_url = f"sqlite:///{tmp_path}/primary.db"
+    replica_urls = [f"sqlite:///{tmp_path}/replica_a.db", f"sqlite:///{tmp_path}/replica_b.db"]
+    seed(primary_url, "primary")
+    seed(replica_urls[0], "replica a")
+    seed(replica_urls[1], "replica b")
+
+    primary = create_engine(primary_url, connect_args={"check_same_thread": False})
+    PrimarySessionLocal = sessionmaker(autoflush=False, bind=primary)
+
+    def override_get_db():
+        session = PrimarySessionLocal()
+        try:
+            yield ThreadedSession(session)
+        finally:
+            session.close()
+
+    router = ReplicaRouter([Replica(url) for url in replica_urls], sticky_seconds=60, eject_seconds=60)
+    monkeypatch.setattr(database, "replica_router", router)
+    # every read has to reach a database for the responses to show which one served it
+    monkeypatch.setattr(response_cache, "backend", None)
+    app.dependency_overrides[get_db] = override_get_db
+    principal_cache.clear()
+
+    client = TestClient(app, raise_server_exceptions=False)
+    client.headers = {**client.headers, "Authorization": f"Bearer {create_access_token({'user_id': 1})}"}
+    yield client, router
+    app.dependency_overrides.pop(get_db, None)
+    primary.dispose()
+
+
+def served_by(client):
+    return client.get("/posts/").json()[0]["Post"]["title"]
+
+
+def test_reads_round_robin_over_replicas(replica_client):
+    client, router = replica_client
+    assert {served_by(client) for _ in range(4)} == {"replica a", "replica b"}
+
+
+def test_read_your_writes_after_write(replica_client):
+    client, router = replica_client
+    res = client.post("/posts/", json={"title": "new post", "content": "content"})
+    assert res.status_code == 201
+
+    # the replicas haven't seen the write, so this client's reads stay on the primary
+    titles = [post["Post"]["title"] for post in client.get("/posts/").json()]
+    assert titles == ["primary", "new post"]
+
+    # stickiness follows the user, so it survives a token refresh
+    refreshed = TestClient(app)
+    refreshed.headers = {**refreshed.headers, "Authorization": f"Bearer {create_access_token({'user_id': 1, 'refreshed': True})}"}
+    assert served_by(refreshed) == "primary"
+
+    other_user = TestClient(app)
+    other_user.headers = {**other_user.headers, "Authorization": f"Bearer {create_access_token({'user_id': 2})}"}
+    assert served_by(other_user) in ("replica a", "replica b")
+
+
+def test_failed_replica_is_ejected(replica_client, tmp_path):
+    client, router = replica_client
+    router.replicas[0] = Replica(f"sqlite:///{tmp_path}/missing/replica.db")
+
+    # the read that hit the broken replica is retried on the other one
+    results = [client.get("/posts/") for _ in range(4)]
+    assert [res.status_code for res in results] == [200] * 4
+    assert not router.replicas[0].healthy()
+    assert all(res.json()[0]["Post"]["title"] == "replica b" for res in results)
+
+
+def test_reads_fall_back_to_primary_when_replicas_fail(replica_client, tmp_path):
+    client, router = replica_client
+    router.replicas[:] = [Replica(f"sqlite:///{tmp_path}/missing/replica_{name}.db") for name in "ab"]
+
+    res = client.get("/posts/")
+    assert res.status_code == 200
+    assert res.json()[0]["Post"]["title"] == "primary"
+    assert not any(replica.healthy() for replica in router.replicas)
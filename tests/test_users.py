@@ -1,7 +1,15 @@
-from app import schemas
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import func, select, update
+from app import schemas, models, utils
 from jose import jwt
 import pytest
 from app.config import settings
+from app.cache import TTLCache
+from app.maintenance import prune_refresh_tokens
+from app.oauth2 import as_utc, create_access_token, verfiy_access_token, revocation_cache, token_cache
 
 # def test_root(client):
 #     res = client.get("/")
@@ -37,3 +45,131 @@ def test_incorrect_login(client, test_user, email, password, status_code):
     assert res.status_code == status_code
     # assert res.json().get('detail') == "Invalid Credentials"
 
+def test_create_user_hash_queue_full(client, monkeypatch):
+    monkeypatch.setattr(settings, "hash_queue_limit", 0)
+    res = client.post("/users/", json={"email": "hello123@gmail.com", "password": "password123"})
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+
+def test_login_hash_queue_full(client, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "hash_queue_limit", 0)
+    res = client.post("/login", data={"username": test_user["email"], "password": test_user["password"]})
+    assert res.status_code == 503
+
+def test_principal_cache_hit(authorized_client, test_posts):
+    before = authorized_client.get("/metrics/").json()["principal_cache"]
+    authorized_client.get("/posts/")
+    authorized_client.get("/posts/")
+    after = authorized_client.get("/metrics/").json()["principal_cache"]
+    assert after["hits"] - before["hits"] >= 1
+    assert after["db_lookups_saved"] == after["hits"]
+
+def test_principal_cache_invalidated_on_user_delete(authorized_client, session, test_user):
+    assert authorized_client.get("/posts/").status_code == 200
+    session.delete(session.get(models.User, test_user['id']))
+    session.commit()
+    assert authorized_client.get("/posts/").status_code == 401
+
+def test_claims_only_skips_user_lookup(authorized_client, session, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "auth_claims_only", True)
+    session.delete(session.get(models.User, test_user['id']))
+    session.commit()
+    res = authorized_client.get("/posts/")
+    assert res.status_code == 200
+
+def test_verify_access_token_is_cached(test_user):
+    credentials_exception = HTTPException(status_code=401)
+    token = create_access_token({"user_id": test_user['id']})
+    token_cache.clear()
+    hits = token_cache.hits
+    first = verfiy_access_token(token, credentials_exception)
+    second = verfiy_access_token(token, credentials_exception)
+    assert first == second
+    assert int(second.id) == test_user['id']
+    assert token_cache.hits == hits + 1
+
+def test_token_cache_never_serves_expired_token():
+    cache = TTLCache(maxsize=10, ttl=300)
+    cache.set("token", "data", expires_at=time.time() - 1)
+    assert cache.get("token") is None
+
+def test_invalid_token_rejected(client):
+    res = client.get("/posts/", headers={"Authorization": "Bearer not-a-jwt"})
+    assert res.status_code == 401
+
+@pytest.fixture
+def login(client, test_user):
+    res = client.post("/login", data={"username": test_user["email"], "password": test_user["password"]})
+    assert res.status_code == 200
+    return schemas.Token(**res.json())
+
+def test_refresh_token_rotates(client, login, monkeypatch):
+    # refreshing never reaches bcrypt: with the hash queue closed a login would get 503
+    monkeypatch.setattr(settings, "hash_queue_limit", 0)
+    res = client.post("/token/refresh", json={"refresh_token": login.refresh_token})
+    assert res.status_code == 200
+    refreshed = schemas.Token(**res.json())
+    assert refreshed.refresh_token != login.refresh_token
+    assert client.get("/posts/", headers={"Authorization": f"Bearer {refreshed.access_token}"}).status_code == 200
+
+    res = client.post("/token/refresh", json={"refresh_token": refreshed.refresh_token})
+    assert res.status_code == 200
+
+def test_reused_refresh_token_revokes_session(client, login):
+    refreshed = schemas.Token(**client.post("/token/refresh", json={"refresh_token": login.refresh_token}).json())
+
+    # the first token was already rotated, so presenting it again means it leaked
+    assert client.post("/token/refresh", json={"refresh_token": login.refresh_token}).status_code == 401
+    assert client.post("/token/refresh", json={"refresh_token": refreshed.refresh_token}).status_code == 401
+    assert client.get("/posts/", headers={"Authorization": f"Bearer {refreshed.access_token}"}).status_code == 401
+
+def test_revoke_refresh_token(client, login):
+    headers = {"Authorization": f"Bearer {login.access_token}"}
+    assert client.get("/posts/", headers=headers).status_code == 200
+    assert client.post("/token/revoke", json={"refresh_token": login.refresh_token}).status_code == 204
+    assert client.post("/token/refresh", json={"refresh_token": login.refresh_token}).status_code == 401
+    assert client.get("/posts/", headers=headers).status_code == 401
+    assert client.post("/token/revoke", json={"refresh_token": "unknown"}).status_code == 204
+
+def test_claims_only_rejects_revoked_session(client, login, monkeypatch):
+    monkeypatch.setattr(settings, "auth_claims_only", True)
+    headers = {"Authorization": f"Bearer {login.access_token}"}
+    assert client.get("/posts/", headers=headers).status_code == 200
+    client.post("/token/revoke", json={"refresh_token": login.refresh_token})
+    # as seen by a worker that didn't handle the logout
+    revocation_cache.clear()
+    assert client.get("/posts/", headers=headers).status_code == 401
+
+def test_revocation_lookup_is_cached(client, login):
+    headers = {"Authorization": f"Bearer {login.access_token}"}
+    client.get("/posts/", headers=headers)
+    misses = client.get("/metrics/").json()["revocation_cache"]["misses"]
+    client.get("/posts/", headers=headers)
+    client.get("/posts/", headers=headers)
+    assert client.get("/metrics/").json()["revocation_cache"]["misses"] == misses
+
+def test_expired_refresh_token_rejected(client, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "refresh_token_expire_days", -1)
+    res = client.post("/login", data={"username": test_user["email"], "password": test_user["password"]})
+    assert client.post("/token/refresh", json={"refresh_token": res.json()["refresh_token"]}).status_code == 401
+
+def test_refresh_token_expiry_compares_in_utc():
+    # an aware value from a database that keeps the offset, and a naive UTC one from one that doesn't
+    assert as_utc(datetime(2030, 1, 1, 3, tzinfo=timezone(timedelta(hours=3)))) == datetime(2030, 1, 1, tzinfo=timezone.utc)
+    assert as_utc(datetime(2030, 1, 1)) == datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+def test_prune_refresh_tokens(client, login, session):
+    refreshed = schemas.Token(**client.post("/token/refresh", json={"refresh_token": login.refresh_token}).json())
+    # the used token from the login has expired, longer ago than an access token lives
+    expired = datetime.utcnow() - timedelta(minutes=settings.access_token_expire_minutes + 1)
+    session.execute(update(models.RefreshToken).where(models.RefreshToken.used).values(expires_at=expired))
+    session.commit()
+
+    assert prune_refresh_tokens(session, dry_run=True) == {"deleted": 1, "dry_run": True}
+    assert prune_refresh_tokens(session, batch_size=1) == {"deleted": 1, "dry_run": False}
+    assert session.scalar(select(func.count()).select_from(models.RefreshToken)) == 1
+    assert client.post("/token/refresh", json={"refresh_token": refreshed.refresh_token}).status_code == 200
+
+def test_hash_workers_use_the_parent_hash_settings():
+    # the workers are spawned, not forked, so conftest's low bcrypt cost has to be handed to them
+    assert asyncio.run(utils.hash_async("password123")).startswith("$2b$04$")
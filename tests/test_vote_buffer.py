@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+import pytest
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import event, insert, select
+from app import models, vote_buffer
+from app.database import ThreadedSession
+from app.vote_buffer import VoteBuffer
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    buffer = VoteBuffer(max_size=1000, flush_seconds=60)
+    monkeypatch.setattr(vote_buffer, "buffer", buffer)
+    return buffer
+
+
+def flush(buffer, session):
+    return asyncio.run(buffer.flush(ThreadedSession(session)))
+
+
+def votes_count(session, post_id):
+    session.expire_all()
+    return session.get(models.Post, post_id).votes_count
+
+
+def test_buffered_vote_is_accepted_and_applied_on_flush(authorized_client, test_posts, session, buffer):
+    post_id = test_posts[3].id
+    res = authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    assert res.status_code == 202
+    assert votes_count(session, post_id) == 0
+
+    assert flush(buffer, session) == {"inserted": 1, "deleted": 0, "dropped": 0}
+    assert votes_count(session, post_id) == 1
+    assert authorized_client.get(f"/posts/{post_id}").json()["votes"] == 1
+
+
+def test_toggles_collapse_to_last_intent(authorized_client, test_posts, session, buffer):
+    post_id = test_posts[0].id
+    for direction in (1, 0, 1, 0, 1):
+        authorized_client.post("/vote/", json={"post_id": post_id, "dir": direction})
+    assert buffer.stats()["pending"] == 1
+
+    flush(buffer, session)
+    assert votes_count(session, post_id) == 1
+    assert session.query(models.Vote).count() == 1
+
+
+def test_flush_drops_duplicates_and_missing_posts(authorized_client, test_posts, test_user, session, buffer):
+    voted, unvoted = test_posts[0].id, test_posts[1].id
+    session.add(models.Vote(post_id=voted, user_id=test_user["id"]))
+    session.execute(models.Post.__table__.update().where(models.Post.id == voted).values(votes_count=1))
+    session.commit()
+
+    authorized_client.post("/vote/", json={"post_id": voted, "dir": 1})
+    authorized_client.post("/vote/", json={"post_id": unvoted, "dir": 0})
+    authorized_client.post("/vote/", json={"post_id": 8888888, "dir": 1})
+
+    assert flush(buffer, session) == {"inserted": 0, "deleted": 0, "dropped": 1}
+    assert votes_count(session, voted) == 1
+    assert votes_count(session, unvoted) == 0
+
+
+def test_full_buffer_flushes_in_request(authorized_client, test_posts, session, monkeypatch):
+    first, second = test_posts[0].id, test_posts[1].id
+    buffer = VoteBuffer(max_size=2, flush_seconds=60)
+    monkeypatch.setattr(vote_buffer, "buffer", buffer)
+
+    authorized_client.post("/vote/", json={"post_id": first, "dir": 1})
+    assert buffer.stats()["flushes"] == 0
+    authorized_client.post("/vote/", json={"post_id": second, "dir": 1})
+    assert buffer.stats() == {"pending": 0, "flushes": 1, "inserted": 2, "deleted": 0, "dropped": 0}
+    assert votes_count(session, first) == 1
+    assert votes_count(session, second) == 1
+
+
+def test_logged_intents_survive_a_restart(authorized_client, test_posts, session, tmp_path, monkeypatch):
+    first, second = test_posts[0].id, test_posts[1].id
+    log_path = str(tmp_path / "votes.log")
+    buffer = VoteBuffer(max_size=1000, flush_seconds=60, log_path=log_path)
+    monkeypatch.setattr(vote_buffer, "buffer", buffer)
+    authorized_client.post("/vote/", json={"post_id": first, "dir": 1})
+    authorized_client.post("/vote/", json={"post_id": second, "dir": 1})
+    # the process dies here without flushing
+    buffer.log.close()
+
+    restarted = VoteBuffer(max_size=1000, flush_seconds=60, log_path=log_path)
+    restarted.pending.update(restarted.log.replay())
+    assert len(restarted.pending) == 2
+    flush(restarted, session)
+    assert votes_count(session, first) == 1
+    assert votes_count(session, second) == 1
+    assert restarted.log.segments() == []
+
+
+def test_stop_waits_for_a_running_flush(test_posts, test_user, session, monkeypatch):
+    first, second = test_posts[0].id, test_posts[1].id
+    started, release = threading.Event(), threading.Event()
+    apply_votes = vote_buffer.apply_votes
+
+    def slow_apply_votes(*args):
+        started.set()
+        release.wait(5)
+        return apply_votes(*args)
+
+    @asynccontextmanager
+    async def session_scope():
+        yield ThreadedSession(session)
+
+    monkeypatch.setattr(vote_buffer, "apply_votes", slow_apply_votes)
+    monkeypatch.setattr(vote_buffer.database, "session_scope", session_scope)
+
+    async def shut_down_mid_flush():
+        buffer = VoteBuffer(max_size=1000, flush_seconds=0.01)
+        await buffer.start()
+        await buffer.add(first, test_user["id"], 1)
+        # the background flush has taken the first vote; the second arrives while it runs
+        await run_in_threadpool(started.wait, 5)
+        await buffer.add(second, test_user["id"], 1)
+        stopping = asyncio.create_task(buffer.stop())
+        await asyncio.sleep(0.05)
+        release.set()
+        await stopping
+        return buffer.stats()
+
+    stats = asyncio.run(shut_down_mid_flush())
+    assert (stats["pending"], stats["flushes"], stats["inserted"]) == (0, 2, 2)
+    assert votes_count(session, first) == 1
+    assert votes_count(session, second) == 1
+
+
+def test_flush_statements_stay_under_sqlite_parameter_limit(test_user, session):
+    session.execute(insert(models.Post), [{"title": f"title {i}", "content": "content", "owner_id": test_user["id"]} for i in range(600)])
+    post_ids = session.scalars(select(models.Post.id)).all()
+    largest = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            largest.append(len(parameters))
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        result = vote_buffer.apply_votes(session, {(post_id, test_user["id"]): 1 for post_id in post_ids})
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert result["inserted"] == 600
+    assert max(largest) <= vote_buffer.MAX_PARAMS
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import pytest
+from starlette.websockets import WebSocketDisconnect
+from app import vote_buffer, vote_stream
+from app.config import settings
+from app.database import ThreadedSession
+from app.vote_buffer import VoteBuffer
+from app.vote_stream import LocalBroker
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = LocalBroker(max_connections=10)
+    monkeypatch.setattr(vote_stream, "broker", broker)
+    monkeypatch.setattr(settings, "vote_stream_coalesce_seconds", 0.05)
+    return broker
+
+
+def test_updates_are_coalesced(broker):
+    async def follow():
+        subscription = broker.subscribe(1)
+        for votes in range(1, 6):
+            await broker.publish(1, votes, votes)
+        await broker.publish(2, 9, 9)
+        latest = await subscription.next(timeout=1, coalesce_seconds=0.05)
+        # published late, from a vote that committed before the one counted above
+        await broker.publish(1, 4, 4)
+        stale = await subscription.next(timeout=0.05, coalesce_seconds=0.05)
+        broker.unsubscribe(subscription)
+        broker.unsubscribe(subscription)
+        return latest, stale, subscription.votes
+
+    assert asyncio.run(follow()) == (5, None, 5)
+    assert broker.stats() == {"backend": "memory", "connections": 0, "posts": 0, "published": 7, "delivered": 6}
+
+
+def test_sse_stream_sends_counts(authorized_client, test_posts, broker, monkeypatch):
+    post_id = test_posts[0].id
+    monkeypatch.setattr(settings, "vote_stream_max_seconds", 1)
+    monkeypatch.setattr(settings, "vote_stream_keepalive_seconds", 0.2)
+    # voted while the stream below is open
+    voter = threading.Timer(0.3, authorized_client.post, args=("/vote/",), kwargs={"json": {"post_id": post_id, "dir": 1}})
+    voter.start()
+    res = authorized_client.get(f"/posts/{post_id}/votes/stream")
+    voter.join()
+
+    assert res.headers["content-type"].startswith("text/event-stream")
+    data = [line for line in res.text.splitlines() if line.startswith("data: ")]
+    assert data == [f'data: {{"post_id": {post_id}, "votes": 0}}', f'data: {{"post_id": {post_id}, "votes": 1}}']
+    assert ": keepalive" in res.text.splitlines()
+    assert broker.connections == 0
+
+
+def test_websocket_receives_counts(authorized_client, test_posts, token, broker):
+    post_id = test_posts[0].id
+    with authorized_client.websocket_connect(f"/posts/{post_id}/votes/ws?token={token}") as websocket:
+        assert websocket.receive_json() == {"post_id": post_id, "votes": 0}
+        authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+        assert websocket.receive_json() == {"post_id": post_id, "votes": 1}
+
+    with pytest.raises(WebSocketDisconnect) as error:
+        with authorized_client.websocket_connect(f"/posts/{post_id}/votes/ws?token=invalid") as websocket:
+            websocket.receive_json()
+    assert error.value.code == 1008
+
+
+def test_stream_limits(authorized_client, test_posts, broker):
+    assert authorized_client.get("/posts/8888888/votes/stream").status_code == 404
+    assert broker.connections == 0
+
+    broker.max_connections = 0
+    res = authorized_client.get(f"/posts/{test_posts[0].id}/votes/stream")
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "5"
+
+
+def test_buffer_flush_publishes_counts(authorized_client, test_posts, session, broker, monkeypatch):
+    post_id = test_posts[0].id
+    buffer = VoteBuffer(max_size=1000, flush_seconds=60)
+    monkeypatch.setattr(vote_buffer, "buffer", buffer)
+    authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+
+    async def flush():
+        subscription = broker.subscribe(post_id)
+        await buffer.flush(ThreadedSession(session))
+        return await subscription.next(timeout=1, coalesce_seconds=0)
+
+    assert asyncio.run(flush()) == 1
@@ -1,5 +1,17 @@
+import asyncio
+import random
+from collections import Counter
+import httpx
 import pytest
-from app import models
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.orm import sessionmaker
+from app import models, response_cache, vote_stream
+from app.database import get_db, Base, ThreadedSession
+from app.main import app
+from app.maintenance import repair_vote_counts
+from app.oauth2 import create_access_token, principal_cache
+from app.vote_stream import LocalBroker
+
 
 @pytest.fixture()
 def test_vote(test_posts, session, test_user):
@@ -7,26 +19,158 @@ def test_vote(test_posts, session, test_user):
     session.add(new_vote)
     session.commit()
 
+
 def test_vote_on_post(authorized_client, test_posts):
     res = authorized_client.post("/vote/", json={"post_id": test_posts[3].id, "dir": 1})
     assert res.status_code == 201
 
+
 def test_vote_twice_post(authorized_client, test_posts, test_vote):
     res = authorized_client.post("/vote/", json={"post_id": test_posts[3].id, "dir": 1})
     assert res.status_code == 409
 
+
 def test_delete_vote(authorized_client, test_posts, test_vote):
     res = authorized_client.post("/vote/", json={"post_id": test_posts[3].id, "dir": 0})
     assert res.status_code == 201
 
+
 def test_delete_vote_non_exist(authorized_client, test_posts):
     res = authorized_client.post("/vote/", json={"post_id": test_posts[3].id, "dir": 0})
     assert res.status_code == 404
 
+
 def test_vote_non_exist(authorized_client, test_posts):
     res = authorized_client.post("/vote/", json={"post_id": 8888888, "dir": 1})
     assert res.status_code == 404
 
+
 def test_vote_unauthorized_user(client, test_posts):
     res = client.post("/vote/", json={"post_id": test_posts[3].id, "dir": 1})
-    assert res.status_code == 401
\ No newline at end of file
+    assert res.status_code == 401
+
+
+def test_vote_updates_votes_count(authorized_client, test_posts):
+    post_id = test_posts[3].id
+    authorized_client.post("/vote/", json={"post_id": post_id, "dir": 1})
+    res = authorized_client.get(f"/posts/{post_id}")
+    assert res.json()["votes"] == 1
+
+    authorized_client.post("/vote/", json={"post_id": post_id, "dir": 0})
+    res = authorized_client.get(f"/posts/{post_id}")
+    assert res.json()["votes"] == 0
+
+
+def test_repair_vote_counts(authorized_client, test_posts, test_vote, session):
+    # test_vote inserts the row directly, so the denormalized count has drifted
+    assert authorized_client.get(f"/posts/{test_posts[3].id}").json()["votes"] == 0
+
+    report = repair_vote_counts(session, batch_size=2)
+    assert report == {"checked": 4, "repaired": 1, "dry_run": False}
+    # the repair runs outside the app, so cached responses only catch up after their TTL
+    asyncio.run(response_cache.clear())
+    assert authorized_client.get(f"/posts/{test_posts[3].id}").json()["votes"] == 1
+    assert repair_vote_counts(session)["repaired"] == 0
+
+
+@pytest.fixture
+def concurrent_app(tmp_path):
+    # a session per request on a sqlite file, so the votes really run side by side in the threadpool
+    engine = create_engine(f"sqlite:///{tmp_path}/votes.db", connect_args={"check_same_thread": False, "timeout": 60}, pool_size=50)
+    # writers still serialize on sqlite's lock; skipping the fsync per commit keeps the queue short
+    event.listen(engine, "connect", lambda dbapi_connection, record: dbapi_connection.execute("PRAGMA synchronous=OFF"))
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(autoflush=False, bind=engine)
+
+    async def override_get_db():
+        db = ThreadedSession(SessionLocal())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    principal_cache.clear()
+    yield SessionLocal
+    app.dependency_overrides.pop(get_db, None)
+    engine.dispose()
+
+
+def test_concurrent_votes_keep_exact_counts(concurrent_app):
+    users, posts = 25, 20
+    with concurrent_app() as db:
+        db.add_all([models.User(email=f"voter{i}@gmail.com", password="x") for i in range(users)])
+        db.flush()
+        db.add_all([models.Post(title=f"title {i}", content="content", owner_id=1) for i in range(posts)])
+        db.commit()
+    tokens = [create_access_token({"user_id": user_id}) for user_id in range(1, users + 1)]
+
+    async def fire(direction):
+        # every (user, post) vote is sent twice at once: one should win, the other get 409 (or 404 when removing)
+        requests = [(token, post_id) for token in tokens for post_id in range(1, posts + 1)] * 2
+        random.Random(direction).shuffle(requests)
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            responses = await asyncio.gather(*(client.post("/vote/", json={"post_id": post_id, "dir": direction},
+                                                           headers={"Authorization": f"Bearer {token}"})
+                                               for token, post_id in requests))
+        return Counter(res.status_code for res in responses)
+
+    def counts():
+        with concurrent_app() as db:
+            stored = dict(db.execute(select(models.Post.id, models.Post.votes_count)).all())
+            actual = dict(db.execute(select(models.Vote.post_id, func.count()).group_by(models.Vote.post_id)).all())
+        return stored, actual
+
+    assert asyncio.run(fire(1)) == {201: users * posts, 409: users * posts}
+    stored, actual = counts()
+    assert stored == actual == {post_id: users for post_id in range(1, posts + 1)}
+
+    assert asyncio.run(fire(0)) == {201: users * posts, 404: users * posts}
+    stored, actual = counts()
+    assert actual == {}
+    assert set(stored.values()) == {0}
+
+
+# without RETURNING (MySQL) the count is read back after the commit
+@pytest.mark.parametrize("returning", [True, False])
+def test_concurrent_votes_stream_the_final_count(concurrent_app, monkeypatch, returning):
+    monkeypatch.setattr(concurrent_app.kw["bind"].dialect, "update_returning", returning)
+    broker = LocalBroker(max_connections=10)
+    monkeypatch.setattr(vote_stream, "broker", broker)
+    delays = random.Random(1)
+
+    async def invalidate(*tags):
+        # the awaits between commit and publish (a Redis invalidation, say) finish out of commit order
+        await asyncio.sleep(delays.random() / 100)
+
+    monkeypatch.setattr(response_cache, "invalidate", invalidate)
+    users = 150
+    with concurrent_app() as db:
+        db.add_all([models.User(email=f"voter{i}@gmail.com", password="x") for i in range(users)])
+        db.flush()
+        db.add(models.Post(title="title", content="content", owner_id=1))
+        db.commit()
+    tokens = [create_access_token({"user_id": user_id}) for user_id in range(1, users + 1)]
+
+    async def fire():
+        subscription = broker.subscribe(1)
+        subscription.offer(0, 0)
+        received = []
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            async def vote(token, direction):
+                await client.post("/vote/", json={"post_id": 1, "dir": direction}, headers={"Authorization": f"Bearer {token}"})
+                received.append(subscription.votes)
+            await asyncio.gather(*(vote(token, 1) for token in tokens))
+            # some take theirs back while others are still arriving
+            await asyncio.gather(*(vote(token, direction) for token, direction in zip(tokens, [0, 1] * users)))
+        return subscription.votes, received
+
+    final, received = asyncio.run(fire())
+    with concurrent_app() as db:
+        stored = db.scalar(select(models.Post.votes_count))
+    assert stored == users - users // 2
+    assert final == stored
+    # while only upvotes were coming in, what the stream held never went backwards
+    assert received[:users] == sorted(received[:users])